@@ -1,75 +1,411 @@
-import requests
-import winreg
-
-def get_proxy():
-    try:
-        with winreg.OpenKey(winreg.HKEY_CURRENT_USER, r"Software\Microsoft\Windows\CurrentVersion\Internet Settings") as key:
-            proxy_enable, _ = winreg.QueryValueEx(key, "ProxyEnable")
-            proxy_server, _ = winreg.QueryValueEx(key, "ProxyServer")
+import gzip
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from usage_stats import usage_tracker, provider_of
+from transport import ConnectionWarmer, transport_from_env
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ERROR_PREFIXES = ("\n发生错误", "request error", "API请求错误")
+BUDGET_EXCEEDED = "API请求错误: 已达到每日花费上限，可在设置中调整"
+
+# 助手窗口、多模型对比和本地服务的助手模型共用的系统提示
+ASSISTANT_PROMPT = "你是一个智能AI助手。"
+
+# 显式缓存断点：稳定前缀达到该长度才标记，服务商对更短的前缀不做缓存
+CACHE_MIN_TOKENS = 1024
+CACHE_CONTROL_HOSTS = ('dashscope.aliyuncs.com', 'openrouter.ai')
+
+# 请求被取消时估算节省的token：该模型还没有成功记录时假定的平均输出长度
+CANCEL_EXPECTED_TOKENS = 300
+
+# 支持用n参数一次返回多个候选的服务商，其余服务商用并发请求取得候选
+N_PARAM_HOSTS = ('api.openai.com',)
+_n_support = {}
+
+LONG_TEXT_CHUNK_TOKENS = 1500
+LONG_TEXT_MAX_WORKERS = 4
+
+# 请求体压缩：默认关闭，开启后按服务商协商，不接受压缩的服务商会被记住并改回明文
+COMPRESS_MIN_BYTES = 1024
+_compress_requests = False
+_compression_support = {}
+# 400的错误信息含这些词时视为服务商不接受压缩；明文重试仍然失败的服务商，之后的400不再重试
+COMPRESSION_ERROR_HINTS = ("encoding", "gzip", "compress")
+_plain_400_hosts = set()
+payload_stats = {"requests": 0, "raw_bytes": 0, "sent_bytes": 0}
+
+# 默认传输层：live模式下为共享连接池，并发分段请求时复用TCP/TLS连接
+_transport = transport_from_env(pool_maxsize=LONG_TEXT_MAX_WORKERS * 2)
+
+
+def set_transport(transport):
+    """替换默认传输层，未指定transport的ChatSession都会使用它"""
+    global _transport
+    _transport = transport
+
+
+# 连接预热，与默认传输层共用连接池
+_warmer = ConnectionWarmer(lambda: _transport)
+_endpoints = {}
+
+
+def prewarm(base_url, reason=""):
+    """在后台预先建立到服务商的连接，首个请求不必再等待DNS、TCP和TLS"""
+    if not base_url:
+        return
+    endpoint = _endpoints.get(base_url)
+    if endpoint is None:
+        endpoint = _endpoints[base_url] = chat_endpoint(base_url)
+    _warmer.warm_async(endpoint, reason)
+
+
+def set_prewarm_budget(per_hour):
+    """设置每小时最多预热次数，0为关闭预热"""
+    _warmer.budget_per_hour = max(int(per_hour), 0)
+
+
+def prewarm_stats():
+    """预热次数、命中次数和估算节省的首请求延迟（秒）"""
+    return dict(_warmer.stats)
+
+
+def set_request_compression(enabled):
+    """开启或关闭请求体gzip压缩"""
+    global _compress_requests
+    _compress_requests = bool(enabled)
+
+
+def dumps(obj):
+    """序列化为紧凑的UTF-8字节，安装了orjson时使用orjson"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def is_error_response(text):
+    """判断返回内容是否为错误信息"""
+    return text is None or text.startswith(ERROR_PREFIXES)
+
+
+class CancelToken:
+    """取消令牌：由界面创建并一路传到ChatSession，取消时立即退出等待并中断上游HTTP流"""
+
+    def __init__(self):
+        self.cancelled = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"取消回调出错: {str(e)}")
+
+    def on_cancel(self, callback):
+        """登记取消回调，已取消时立即执行；返回用于注销的函数"""
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return lambda: self._discard(callback)
+        callback()
+        return lambda: None
+
+    def _discard(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+class _Flight:
+    """一次正在进行的上游请求，结果或流式增量会分发给所有等待者"""
+
+    def __init__(self, key):
+        self.key = key
+        self.events = []
+        self.result = None
+        self.choices = None
+        self.usage = None
+        self.done = False
+        self.cancelled = False
+        self.waiters = 0
+        self._closers = []
+        self._cond = threading.Condition()
+
+    def emit(self, delta):
+        """推送一段流式增量"""
+        with self._cond:
+            self.events.append(delta)
+            self._cond.notify_all()
+
+    def finish(self, result):
+        with self._cond:
+            self.result = result
+            self.done = True
+            self._cond.notify_all()
+
+    def on_cancel(self, closer):
+        """登记中断上游请求的回调，已取消时立即执行"""
+        with self._cond:
+            if not self.cancelled:
+                self._closers.append(closer)
+                return
+        closer()
+
+    def cancel(self):
+        with self._cond:
+            if self.cancelled or self.done:
+                return
+            self.cancelled = True
+            closers, self._closers = self._closers, []
+            self._cond.notify_all()
+        for closer in closers:
+            try:
+                closer()
+            except Exception as e:
+                print(f"中断请求失败: {str(e)}")
+
+    def _wake(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def wait(self, cancel_token=None):
+        """等待请求结束并返回结果，令牌取消时立即返回None"""
+        unregister = cancel_token.on_cancel(self._wake) if cancel_token else None
+        try:
+            with self._cond:
+                while not self.done and not self.cancelled:
+                    if cancel_token and cancel_token.cancelled:
+                        return None
+                    self._cond.wait()
+                return self.result
+        finally:
+            if unregister:
+                unregister()
+
+    def stream(self, cancel_token=None):
+        """从头依次产出流式增量，后加入的等待者也能收到完整内容；令牌取消时立即停止"""
+        unregister = cancel_token.on_cancel(self._wake) if cancel_token else None
+        index = 0
+        try:
+            while True:
+                with self._cond:
+                    while (index >= len(self.events) and not self.done and not self.cancelled
+                           and not (cancel_token and cancel_token.cancelled)):
+                        self._cond.wait()
+                    if cancel_token and cancel_token.cancelled:
+                        return
+                    pending = self.events[index:]
+                    index = len(self.events)
+                    finished = self.done or self.cancelled
+                for delta in pending:
+                    if cancel_token and cancel_token.cancelled:
+                        return
+                    yield delta
+                if finished and index >= len(self.events):
+                    return
+        finally:
+            if unregister:
+                unregister()
+
+    def release(self):
+        """等待者退出；最后一个等待者退出时若请求未完成则中断上游"""
+        _inflight.release(self)
+
+
+class SingleFlight:
+    """合并相同的进行中请求：只发送一次上游请求，结果分发给所有等待者"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def join(self, key, producer):
+        """
+        加入或发起一次请求，调用方用完后必须调用 flight.release()
+        :param key: 请求的唯一标识
+        :param producer: producer(flight)，在后台线程中执行上游请求并返回最终结果
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None or flight.cancelled:
+                flight = _Flight(key)
+                self._flights[key] = flight
+                threading.Thread(target=self._run, args=(flight, producer), daemon=True).start()
+            else:
+                print("相同请求正在进行，等待共享结果")
+            flight.waiters += 1
+        return flight
+
+    def release(self, flight):
+        with self._lock:
+            flight.waiters -= 1
+            abandoned = flight.waiters <= 0 and not flight.done
+            if abandoned and self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+        if abandoned:
+            flight.cancel()
+
+    def discard(self, flight):
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def _run(self, flight, producer):
+        result = None
+        try:
+            result = producer(flight)
+        except Exception as e:
+            result = f"\n发生错误: {str(e)}"
+            print(result)
+        finally:
+            self.discard(flight)
+            flight.finish(result)
+
+
+_inflight = SingleFlight()
+
+
+def normalize_message(message):
+    """复制为只含 role/content 且键顺序固定的消息，保证序列化后的前缀逐字节一致"""
+    return {"role": message["role"], "content": message["content"]}
+
+
+def parse_usage(usage):
+    """
+    解析各服务商返回的usage，统一为输入/输出/缓存命中/未命中token数
+    兼容 OpenAI 系 prompt_tokens_details.cached_tokens、DeepSeek prompt_cache_hit_tokens
+    以及 Anthropic 系 cache_read_input_tokens
+    Anthropic 系的 input_tokens 只是未命中缓存的部分，总输入还要加上缓存读取和写入的token
+    """
+    if not usage:
+        return None
+    completion = usage.get("completion_tokens") or usage.get("output_tokens") or 0
+    if "prompt_tokens" not in usage and ("cache_read_input_tokens" in usage
+                                         or "cache_creation_input_tokens" in usage):
+        uncached = usage.get("input_tokens") or 0
+        cached = usage.get("cache_read_input_tokens") or 0
+        prompt = uncached + cached + (usage.get("cache_creation_input_tokens") or 0)
+        return {
+            "prompt_tokens": prompt,
+            "completion_tokens": completion,
+            "cached_tokens": cached,
+            "uncached_tokens": uncached
+        }
+
+    prompt = usage.get("prompt_tokens") or usage.get("input_tokens") or 0
+    details = usage.get("prompt_tokens_details") or {}
+    cached = (details.get("cached_tokens")
+              or usage.get("prompt_cache_hit_tokens")
+              or 0)
+    if "prompt_cache_miss_tokens" in usage:
+        uncached = usage["prompt_cache_miss_tokens"]
+    else:
+        uncached = max(prompt - cached, 0)
+    return {
+        "prompt_tokens": prompt,
+        "completion_tokens": completion,
+        "cached_tokens": cached,
+        "uncached_tokens": uncached
+    }
+
+
+def chat_endpoint(base_url):
+    """由设置中的API URL得到chat/completions接口地址"""
+    base_url = base_url.rstrip('/')
+    
+    if 'googleapis.com' in base_url.lower():
+        return f"{base_url}/v1beta/chat/completions"
+    elif 'bigmodel.cn' in base_url.lower():
+        return f"{base_url}/api/paas/v4/chat/completions"
+    elif 'volces.com' in base_url.lower():
+        return f"{base_url}/api/v3/chat/completions"    
+    else:
+        if not base_url.startswith(('http://', 'https://')):
+            base_url = 'https://' + base_url
             
-            if proxy_enable and proxy_server:
-                proxy_parts = proxy_server.split(":")
-                if len(proxy_parts) == 2:
-                    return {"http": f"http://{proxy_server}", "https": f"http://{proxy_server}"}
-    except WindowsError:
-        pass
-    return {"http": None, "https": None}
+        if not '/chat/completions' in base_url.lower():              
+            if '/v1' in base_url:
+                base_url = f"{base_url}/chat/completions"
+            else:
+                base_url = f"{base_url}/v1/chat/completions"
+                
+            print(f"已添加标准endpoint -> {base_url}")
+            
+        return base_url
 
 
 class ChatSession:
-    def __init__(self, api_key, base_url, model, system_prompt):
+    def __init__(self, api_key, base_url, model, system_prompt, max_history=None, transport=None):
         """
         初始化聊天会话
         :param api_key: API密钥
         :param base_url: API基础URL
         :param model: 使用的模型名称
         :param system_prompt: 系统提示，用于设定AI角色
+        :param max_history: 历史记录最多保留的消息条数，None为不限制
+        :param transport: 传输层（见transport.py），None为使用默认传输层
         """
-        base_url = base_url.rstrip('/')
-        
-        if 'googleapis.com' in base_url.lower():
-            self.base_url = f"{base_url}/v1beta/chat/completions"
-        elif 'bigmodel.cn' in base_url.lower():
-            self.base_url = f"{base_url}/api/paas/v4/chat/completions"
-        elif 'volces.com' in base_url.lower():
-            self.base_url = f"{base_url}/api/v3/chat/completions"    
-        else:
-            if not base_url.startswith(('http://', 'https://')):
-                base_url = 'https://' + base_url
-                
-            if not '/chat/completions' in base_url.lower():              
-                if '/v1' in base_url:
-                    base_url = f"{base_url}/chat/completions"
-                else:
-                    base_url = f"{base_url}/v1/chat/completions"
-                    
-                print(f"已添加标准endpoint -> {base_url}")
-                
-            self.base_url = base_url
-        
+        self.base_url = chat_endpoint(base_url)
         self.api_key = api_key
         self.model = model
-        self.system_prompt = system_prompt
+        self.system_prompt = normalize_message(system_prompt)
+        self.max_history = max_history
+        self._transport = transport
         self.message_history = []
+        self.session_id = uuid.uuid4().hex[:8]
+        self.last_usage = None
+        self._encoded = {}
+        self.cache_stats = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0}
         
     def get_full_context(self, user_message):
-        """构建完整的消息上下文"""
-        return [self.system_prompt] + self.message_history + [user_message]
+        """
+        构建完整的消息上下文
+        系统提示在前、历史按时间追加、新消息在最后，历史只追加不改写，
+        因此相邻两轮请求的前缀逐字节一致，可以命中服务商的提示缓存
+        """
+        return [self.system_prompt] + self.message_history + [normalize_message(user_message)]
         
     def add_to_history(self, message):
-        """添加消息到历史记录"""
-        self.message_history.append(message)
+        """
+        添加消息到历史记录
+        超出 max_history 时一次丢弃较早的一半，而不是每轮丢一条，
+        这样两次裁剪之间的上下文前缀保持不变，仍可命中提示缓存
+        """
+        self.message_history.append(normalize_message(message))
+        if self.max_history and len(self.message_history) > self.max_history:
+            keep = self.max_history // 2
+            history = self.message_history[-keep:] if keep else []
+            while history and history[0]["role"] != "user":
+                history.pop(0)
+            self.message_history = history
         
     def clear_history(self):
         """清空历史记录"""
         self.message_history = []
         
-    def chat(self, user_input, temperature=0.7, max_tokens=2000):
+    def chat(self, user_input, temperature=0.7, max_tokens=2000, cancel_token=None):
         """
         发送消息并获取回复
         :param user_input: 用户输入的消息
         :param temperature: 温度参数，控制回复的随机性
         :param max_tokens: 回复的最大token数量
+        :param cancel_token: 可选的取消令牌，取消后返回None且不写入历史
         """
         if self.api_key is None:
             print("api_key is None")
@@ -85,28 +421,342 @@ class ChatSession:
             print(f"{i}. {msg['role']}: {msg['content']}")
         print("==================\n")
         
-        headers = {
+        ai_response = self._request(message_context, temperature, max_tokens, cancel_token)
+        if ai_response and not is_error_response(ai_response):
+            self.add_to_history(user_message)
+            self.add_to_history({"role": "assistant", "content": ai_response})
+
+        return ai_response
+
+    def chat_stream(self, user_input, temperature=0.7, max_tokens=2000, cancel_token=None):
+        """
+        流式发送消息，逐段产出回复内容，结束后写入历史记录
+        :param user_input: 用户输入的消息
+        :param temperature: 温度参数
+        :param max_tokens: 回复的最大token数量
+        :param cancel_token: 可选的取消令牌，取消后立即停止产出，不写入历史
+        """
+        if self.api_key is None:
+            print("api_key is None")
+            return
+
+        user_message = {"role": "user", "content": user_input}
+        outcome = {}
+        yield from self._stream_request(self.get_full_context(user_message), temperature, max_tokens,
+                                        outcome, cancel_token)
+
+        ai_response = outcome.get('result')
+        if ai_response and not is_error_response(ai_response):
+            self.add_to_history(user_message)
+            self.add_to_history({"role": "assistant", "content": ai_response})
+
+    @property
+    def transport(self):
+        return self._transport or _transport
+
+    def chat_candidates(self, user_input, n=3, temperature=0.7, max_tokens=2000, cancel_token=None, outcome=None):
+        """
+        流式产出第一个候选，同时取得其余候选，结束后只把第一个候选写入历史记录
+        支持n参数的服务商一次请求返回全部候选，其余服务商额外并发发送n-1个不合并的请求
+        :param n: 候选数量
+        :param outcome: 可选字典，结束后写入 choices（全部有效候选，第一个为流式产出的那个）
+        """
+        if self.api_key is None:
+            print("api_key is None")
+            return
+
+        user_message = {"role": "user", "content": user_input}
+        messages = self.get_full_context(user_message)
+        use_n = n > 1 and self.supports_n()
+        futures = [] if use_n else self._alternatives(messages, n - 1, temperature, max_tokens, cancel_token)
+
+        streamed = {}
+        yield from self._stream_request(messages, temperature, max_tokens, streamed, cancel_token,
+                                        n if use_n else 1)
+        if cancel_token and cancel_token.cancelled:
+            return
+
+        first = streamed.get('result')
+        choices = list(streamed.get('choices') or [])
+        if use_n and first and not is_error_response(first) and len(choices) < n:
+            # 服务商忽略了n参数，记住后改为并发请求，并补齐缺少的候选
+            host = provider_of(self.base_url)
+            _n_support[host] = False
+            print(f"{host} 不支持n参数，改为并发请求候选")
+            futures = self._alternatives(messages, n - len(choices), temperature, max_tokens, cancel_token)
+        choices += [f.result() for f in futures]
+        if outcome is not None:
+            outcome['choices'] = [c for c in choices if c and not is_error_response(c)]
+        if first and not is_error_response(first):
+            self.add_to_history(user_message)
+            self.add_to_history({"role": "assistant", "content": first})
+
+    def _alternatives(self, messages, count, temperature, max_tokens, cancel_token):
+        """并发发送count个不合并的相同请求，返回future列表"""
+        if count <= 0:
+            return []
+        executor = ThreadPoolExecutor(max_workers=count)
+        futures = [executor.submit(self._request, messages, temperature, max_tokens, cancel_token, False)
+                   for _ in range(count)]
+        executor.shutdown(wait=False)
+        return futures
+
+    def replace_last_reply(self, content):
+        """把历史中最后一条回复换成用户选定的候选，新对象不会复用旧的编码缓存"""
+        if self.message_history and self.message_history[-1]["role"] == "assistant":
+            self.message_history[-1] = {"role": "assistant", "content": content}
+
+    def _headers(self):
+        return {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}"
         }
 
+    def supports_cache_control(self):
+        """服务商是否支持在消息中显式标记缓存断点"""
+        return any(host in self.base_url.lower() for host in CACHE_CONTROL_HOSTS)
+
+    def _with_cache_breakpoints(self, messages):
+        """
+        在系统提示和最后一条历史消息上标记缓存断点
+        新的用户消息之前的部分是稳定前缀，下一轮请求会原样复用
+        """
+        if len(messages) < 2 or not self.supports_cache_control():
+            return messages
+        if sum(estimate_tokens(m["content"]) for m in messages[:-1]) < CACHE_MIN_TOKENS:
+            return messages
+
+        marked = list(messages)
+        for index in sorted({0, len(messages) - 2}):
+            message = marked[index]
+            marked[index] = {
+                "role": message["role"],
+                "content": [{
+                    "type": "text",
+                    "text": message["content"],
+                    "cache_control": {"type": "ephemeral"}
+                }]
+            }
+        return marked
+
+    def supports_n(self):
+        """服务商是否支持n参数；返回的候选少于请求数量后会记住不支持"""
+        host = provider_of(self.base_url)
+        return _n_support.get(host, host in N_PARAM_HOSTS)
+
+    def _payload(self, messages, temperature, max_tokens, stream, n=1):
         data = {
             "model": self.model,
-            "messages": message_context,
+            "messages": self._with_cache_breakpoints(messages),
             "temperature": temperature,
             "max_tokens": max_tokens,
-            "stream": False
+            "stream": stream
         }
+        if n > 1:
+            data["n"] = n
+        if stream:
+            data["stream_options"] = {"include_usage": True}
+        return data
+
+    def _record_usage(self, usage):
+        """记录本次请求的token用量，并打印缓存命中情况"""
+        self.last_usage = usage
+        if not usage:
+            return
+        self.cache_stats["requests"] += 1
+        self.cache_stats["prompt_tokens"] += usage["prompt_tokens"]
+        self.cache_stats["cached_tokens"] += usage["cached_tokens"]
+        total = self.cache_stats["prompt_tokens"]
+        rate = self.cache_stats["cached_tokens"] / total * 100 if total else 0
+        print(f"token用量: 输入{usage['prompt_tokens']}（缓存命中{usage['cached_tokens']}，"
+              f"未命中{usage['uncached_tokens']}），输出{usage['completion_tokens']}；"
+              f"本会话缓存命中率{rate:.1f}%")
+
+    def _encode_body(self, data):
+        """
+        序列化请求体；每条消息的编码结果按对象缓存，
+        历史消息只追加不改写，多轮对话时只需编码新增的消息
+        """
+        encoded = {}
+        parts = []
+        for message in data["messages"]:
+            entry = self._encoded.get(id(message))
+            if entry is None or entry[0] is not message:
+                entry = (message, dumps(message))
+            encoded[id(message)] = entry
+            parts.append(entry[1])
+        self._encoded = encoded
+        rest = dumps({k: v for k, v in data.items() if k != "messages"})
+        return b'{"messages":[' + b','.join(parts) + b'],' + rest[1:]
 
+    def _flight_key(self, body):
+        """相同服务商、密钥、模型、消息和参数的请求共用同一个key"""
+        digest = hashlib.sha256(f"{self.base_url}\n{self.api_key}\n".encode('utf-8'))
+        digest.update(body)
+        return digest.hexdigest()
+
+    def _request(self, messages, temperature=0.7, max_tokens=2000, cancel_token=None, coalesce=True):
+        """
+        发送一次请求并返回回复内容，不读写历史记录
+        相同的请求正在进行时直接等待其结果，不再重复发送
+        :param messages: 完整的消息列表
+        :param temperature: 温度参数
+        :param max_tokens: 回复的最大token数量
+        :param cancel_token: 取消令牌，取消后立即返回None
+        :param coalesce: 为False时总是单独发送，用于同时取得多个不同的候选
+        """
+        if usage_tracker.over_budget():
+            print(BUDGET_EXCEEDED)
+            return BUDGET_EXCEEDED
+        body = self._encode_body(self._payload(messages, temperature, max_tokens, False))
+        key = self._flight_key(body) if coalesce else uuid.uuid4().hex
+        flight = _inflight.join(key,
+                                lambda f: self._accounted(self._post, body, f, max_tokens))
+        try:
+            result = flight.wait(cancel_token)
+            self._record_usage(flight.usage)
+            return result
+        finally:
+            flight.release()
+
+    def _stream_request(self, messages, temperature=0.7, max_tokens=2000, outcome=None, cancel_token=None, n=1):
+        """
+        流式请求，逐段产出回复内容；相同的流式请求正在进行时共享同一个上游流
+        提前关闭生成器或取消令牌即退出等待，所有等待者都退出后上游HTTP流会被立即关闭
+        :param outcome: 可选字典，结束后写入 result（完整回复或错误信息，取消时为None）和 choices（全部候选）
+        :param cancel_token: 取消令牌
+        :param n: 候选数量，大于1时只流式产出第一个候选，其余候选写入 outcome['choices']
+        """
+        if usage_tracker.over_budget():
+            print(BUDGET_EXCEEDED)
+            if outcome is not None:
+                outcome['result'] = BUDGET_EXCEEDED
+            yield BUDGET_EXCEEDED
+            return
+        body = self._encode_body(self._payload(messages, temperature, max_tokens, True, n))
+        flight = _inflight.join(self._flight_key(body),
+                                lambda f: self._accounted(self._post_stream, body, f, max_tokens))
         try:
-            response = requests.post(
+            yield from flight.stream(cancel_token)
+            if cancel_token and cancel_token.cancelled:
+                print("请求已取消")
+                return
+            if is_error_response(flight.result) and flight.result:
+                yield flight.result
+            self._record_usage(flight.usage)
+            if outcome is not None:
+                outcome['result'] = flight.result
+                outcome['choices'] = flight.choices
+        finally:
+            flight.release()
+
+    def _accounted(self, send, body, flight, max_tokens):
+        """
+        执行上游请求并记录用量；合并的请求只记录一次
+        请求被取消时服务商不会返回usage，按已收到的内容估算输出token，
+        并以该模型的平均输出长度估算节省的token数
+        """
+        provider = provider_of(self.base_url)
+        start = time.monotonic()
+        result = send(body, flight)
+        usage = flight.usage
+        tokens_saved = 0
+        if flight.cancelled:
+            status = "cancelled"
+            received = estimate_tokens("".join(flight.events))
+            if usage is None:
+                usage = {
+                    "prompt_tokens": estimate_tokens(body.decode('utf-8', 'ignore')),
+                    "completion_tokens": received,
+                    "cached_tokens": 0,
+                    "uncached_tokens": 0
+                }
+            expected = usage_tracker.expected_completion_tokens(provider, self.model) or CANCEL_EXPECTED_TOKENS
+            tokens_saved = max(min(expected, max_tokens) - received, 0)
+            print(f"请求已中断，约节省{tokens_saved}个输出token")
+        elif is_error_response(result):
+            status = "error"
+        else:
+            status = "ok"
+        usage_tracker.record(provider, self.model, usage, time.monotonic() - start,
+                             status, self.session_id, tokens_saved)
+        return result
+
+    def _send(self, body, stream=False):
+        """
+        发送已序列化的请求体
+        开启压缩且请求体足够大时使用gzip；服务商以415拒绝，或以400拒绝且可能与压缩有关时明文重试，
+        重试成功则记住该服务商不支持压缩，之后直接发送明文
+        """
+        host = provider_of(self.base_url)
+        headers = self._headers()
+        headers["Accept-Encoding"] = "gzip, deflate"
+        compress = (_compress_requests and len(body) >= COMPRESS_MIN_BYTES
+                    and _compression_support.get(host, True))
+        sent = gzip.compress(body, compresslevel=6) if compress else body
+        if compress:
+            headers["Content-Encoding"] = "gzip"
+
+        _warmer.note_request(self.base_url)
+        payload_stats["requests"] += 1
+        payload_stats["raw_bytes"] += len(body)
+        payload_stats["sent_bytes"] += len(sent)
+        print(f"请求体: {len(body)}B -> {len(sent)}B{'（gzip）' if compress else ''}，"
+              f"累计 {payload_stats['raw_bytes']}B -> {payload_stats['sent_bytes']}B")
+
+        response = self.transport.post(
+            self.base_url,
+            headers=headers,
+            data=sent,
+            timeout=30,
+            stream=stream
+        )
+        if compress and self._compression_rejected(host, response):
+            response.close()
+            del headers["Content-Encoding"]
+            # 重试的明文同样上了线路；原始字节不重复计入，累计值体现压缩被拒绝多花的流量
+            payload_stats["requests"] += 1
+            payload_stats["sent_bytes"] += len(body)
+            print(f"明文重试: 再发送 {len(body)}B，"
+                  f"累计 {payload_stats['raw_bytes']}B -> {payload_stats['sent_bytes']}B")
+            response = self.transport.post(
                 self.base_url,
                 headers=headers,
-                json=data,
-                proxies=get_proxy(),
-                verify=True,
-                timeout=30
+                data=body,
+                timeout=30,
+                stream=stream
             )
+            if response.status_code == 200:
+                _compression_support[host] = False
+                print(f"{host} 不接受压缩的请求体，之后改为明文发送")
+            elif response.status_code == 400:
+                _plain_400_hosts.add(host)
+                print(f"{host} 明文请求同样返回400，之后的400不再按压缩问题重试")
+        elif compress and response.status_code == 200:
+            _compression_support[host] = True
+        return response
+
+    def _compression_rejected(self, host, response):
+        """压缩的请求被拒绝时，判断是否可能是服务商不接受压缩"""
+        if response.status_code == 415:
+            return True
+        if response.status_code != 400:
+            return False
+        try:
+            text = response.text.lower()
+        except Exception:
+            text = ""
+        if any(hint in text for hint in COMPRESSION_ERROR_HINTS):
+            return True
+        # 错误信息看不出原因时，只在还没确认过该服务商的情况下明文试一次
+        return host not in _compression_support and host not in _plain_400_hosts
+
+    def _post(self, body, flight):
+        """实际发送非流式请求；以流式方式读取响应体，取消时可立即关闭连接"""
+        response = None
+        try:
+            response = self._send(body, stream=True)
+            flight.on_cancel(response.close)
             
             if response.status_code != 200:
                 error_msg = f"API请求错误: HTTP {response.status_code}\n{response.text}"
@@ -114,32 +764,122 @@ class ChatSession:
                 return error_msg
 
             response_data = response.json()
+            flight.usage = parse_usage(response_data.get("usage"))
             if "choices" in response_data and len(response_data["choices"]) > 0:
-                ai_response = response_data["choices"][0]["message"]["content"]
-                
-                if not ai_response.startswith(("\n发生错误", "request error", "API请求错误")):
-                    self.add_to_history(user_message)
-                    self.add_to_history({"role": "assistant", "content": ai_response})
-                
-                return ai_response
+                choices = sorted(response_data["choices"], key=lambda c: c.get("index", 0))
+                flight.choices = [c["message"]["content"] for c in choices]
+                return flight.choices[0]
             
             return None
 
         except Exception as e:
+            if flight.cancelled:
+                return None
             error_msg = f"\n发生错误: {str(e)}"
             print(error_msg)
             return error_msg
+        finally:
+            # 读完或中断后释放：读完的连接归还连接池，中断的连接被丢弃，不会被复用
+            if response is not None:
+                response.close()
+
+    def _post_stream(self, body, flight):
+        """实际发送流式请求，解析SSE并把增量内容推送给所有等待者"""
+        response = None
+        try:
+            response = self._send(body, stream=True)
+            flight.on_cancel(response.close)
+
+            if response.status_code != 200:
+                error_msg = f"API请求错误: HTTP {response.status_code}\n{response.text}"
+                print(error_msg)
+                return error_msg
+
+            parts = []
+            # n>1时其余候选的增量按index收集，不推送给等待者
+            extras = {}
+            lines = response.iter_lines()
+            for line in lines:
+                if flight.cancelled:
+                    break
+                if not line or not line.startswith(b"data:"):
+                    continue
+                payload = line[5:].strip()
+                if payload == b"[DONE]":
+                    # 读完结束标记之后剩余的分块（通常只有结尾的空块），
+                    # 响应体读到末尾后连接才会归还连接池，否则close会直接断开
+                    for _ in lines:
+                        if flight.cancelled:
+                            break
+                    break
+                chunk = json.loads(payload.decode('utf-8'))
+                if "error" in chunk:
+                    error_msg = f"API请求错误: {chunk['error']}"
+                    print(error_msg)
+                    return error_msg
+                if chunk.get("usage"):
+                    flight.usage = parse_usage(chunk["usage"])
+                for choice in chunk.get("choices") or []:
+                    delta = (choice.get("delta") or {}).get("content")
+                    if not delta:
+                        continue
+                    index = choice.get("index", 0)
+                    if index == 0:
+                        parts.append(delta)
+                        flight.emit(delta)
+                    else:
+                        extras.setdefault(index, []).append(delta)
+            result = "".join(parts)
+            flight.choices = [result] + ["".join(extras[i]) for i in sorted(extras)]
+            return result
+
+        except Exception as e:
+            if flight.cancelled:
+                return None
+            error_msg = f"\n发生错误: {str(e)}"
+            print(error_msg)
+            return error_msg
+        finally:
+            if response is not None:
+                response.close()
+
+    def ask_once(self, prompt, temperature=0.7, max_tokens=2000, cancel_token=None):
+        """
+        以系统提示+单条用户消息发送请求，不带历史也不写入历史
+        :param prompt: 用户消息内容
+        """
+        if self.api_key is None:
+            print("api_key is None")
+            return None
+        return self._request([self.system_prompt, {"role": "user", "content": prompt}],
+                             temperature, max_tokens, cancel_token)
+
+    def complete_messages(self, messages, temperature=0.7, max_tokens=2000, cancel_token=None):
+        """
+        以调用方给出的完整消息列表发送请求，不带也不写入历史记录
+        :param messages: 完整的消息列表，系统提示需自行包含
+        """
+        if self.api_key is None:
+            print("api_key is None")
+            return None
+        return self._request([normalize_message(m) for m in messages], temperature, max_tokens, cancel_token)
+
+    def stream_messages(self, messages, temperature=0.7, max_tokens=2000, outcome=None, cancel_token=None):
+        """complete_messages 的流式版本，逐段产出回复内容"""
+        if self.api_key is None:
+            print("api_key is None")
+            return
+        yield from self._stream_request([normalize_message(m) for m in messages],
+                                        temperature, max_tokens, outcome, cancel_token)
 
     def get_models(self):
         """获取可用的模型列表"""
         if 'googleapis.com' in self.base_url:
             models_url = "https://generativelanguage.googleapis.com/v1beta/models"
             try:
-                response = requests.get(
+                response = self.transport.get(
                     models_url,
                     params={'key': self.api_key},
-                    proxies=get_proxy(),
-                    verify=True,
                     timeout=10
                 )
                 
@@ -159,11 +899,9 @@ class ChatSession:
             base_url = self.base_url.split('/chat/completions')[0]
             models_url = f"{base_url}/models"
             try:
-                response = requests.get(
+                response = self.transport.get(
                     models_url,
                     headers={"Authorization": f"Bearer {self.api_key}"},
-                    proxies=get_proxy(),
-                    verify=True,
                     timeout=10
                 )
                 
@@ -174,3 +912,351 @@ class ChatSession:
             except Exception as e:
                 print(f"获取模型列表失败: {str(e)}")
                 return []
+
+
+def estimate_tokens(text):
+    """粗略估算token数：中日韩字符每字约1个token，其余字符约4个字符1个token"""
+    if not text:
+        return 0
+    cjk = len(re.findall(r'[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af\uff00-\uffef]', text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _hard_split(text, max_tokens):
+    """无可用边界时按字符硬切分"""
+    pieces = []
+    current = ""
+    for char in text:
+        if current and estimate_tokens(current + char) > max_tokens:
+            pieces.append(current)
+            current = ""
+        current += char
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def _pack(units, max_tokens, sep):
+    """把切分单元贪心合并为不超过预算的分段"""
+    chunks = []
+    current = ""
+    for unit in units:
+        candidate = f"{current}{sep}{unit}" if current else unit
+        if current and estimate_tokens(candidate) > max_tokens:
+            chunks.append(current)
+            current = unit
+        else:
+            current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def split_text(text, max_tokens=LONG_TEXT_CHUNK_TOKENS):
+    """
+    按段落、句子边界把长文本切分为不超过预算的分段
+    :param text: 原始文本
+    :param max_tokens: 每段的token预算
+    """
+    text = text.strip()
+    if estimate_tokens(text) <= max_tokens:
+        return [text] if text else []
+
+    units = []
+    for paragraph in re.split(r'\n\s*\n', text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if estimate_tokens(paragraph) <= max_tokens:
+            units.append(paragraph)
+            continue
+        # 中文标点后直接断句，英文标点后须有空白才断句（避免切开3.14、example.com），
+        # 断句处的空白和换行留在前一句末尾，按原样拼回
+        parts = re.split(r'((?<=[。！？；])\s*|(?<=[.!?;])\s+|\n\s*)', paragraph)
+        sentences = [parts[i] + (parts[i + 1] if i + 1 < len(parts) else "")
+                     for i in range(0, len(parts), 2)]
+        pieces = []
+        for sentence in sentences:
+            if not sentence:
+                continue
+            if estimate_tokens(sentence) > max_tokens:
+                pieces.extend(_hard_split(sentence, max_tokens))
+            else:
+                pieces.append(sentence)
+        units.extend(chunk.strip() for chunk in _pack(pieces, max_tokens, ""))
+
+    return _pack(units, max_tokens, "\n\n")
+
+
+class SectionParser:
+    """
+    把流式回复按单独一行的【标题】标记实时切分为多个部分
+    标记可能被拆在相邻的两段增量中，可能是标记开头的尾部内容会暂存到下一段再判断；
+    各部分首尾的空白行会被去掉
+    """
+
+    def __init__(self, titles):
+        """
+        :param titles: 允许出现的标题，如 ["翻译", "解释", "总结"]
+        """
+        self.markers = {f"【{title}】": title for title in titles}
+        self.current = None
+        self._buffer = ""
+        self._fresh = False
+
+    def _emit(self, out, text):
+        if self._fresh:
+            text = text.lstrip()
+            self._fresh = not text
+        if text:
+            out.append((self.current, text))
+
+    def feed(self, delta):
+        """
+        输入一段增量，返回可以确定归属的 [(title, text)] 列表
+        title为None表示第一个标记之前的内容；遇到新标记时先返回 (title, "") 表示该部分开始
+        """
+        self._buffer += delta
+        out = []
+        while True:
+            found = min(((self._buffer.find(m), m) for m in self.markers if m in self._buffer), default=None)
+            if found is None:
+                break
+            pos, marker = found
+            self._emit(out, self._buffer[:pos].rstrip())
+            self.current = self.markers[marker]
+            self._fresh = True
+            out.append((self.current, ""))
+            self._buffer = self._buffer[pos + len(marker):]
+        hold = self._buffer.rfind("【")
+        if hold == -1 or not any(m.startswith(self._buffer[hold:]) for m in self.markers):
+            hold = len(self._buffer)
+        # 末尾的空白可能紧接着下一个标记，等看到后续内容再输出
+        hold = len(self._buffer[:hold].rstrip())
+        self._emit(out, self._buffer[:hold])
+        self._buffer = self._buffer[hold:]
+        return out
+
+    def flush(self):
+        """回复结束时取出暂存的内容"""
+        out = []
+        self._emit(out, self._buffer.rstrip())
+        self._buffer = ""
+        return out
+
+
+class ChatSessionPool:
+    """按上下文key保存长期使用的ChatSession，超出数量时淘汰最久未用的，空闲超时后重建"""
+
+    def __init__(self, factory, max_sessions=16, idle_ttl=1800):
+        """
+        :param factory: 创建新会话的函数 factory(key)
+        :param max_sessions: 最多保留的会话数
+        :param idle_ttl: 会话空闲多少秒后过期
+        """
+        self.factory = factory
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """取出key对应的会话，不存在或已过期时新建"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._sessions.pop(key, None)
+            if entry is not None and now - entry[1] > self.idle_ttl:
+                print(f"补全会话已过期: {key}")
+                entry = None
+            session = entry[0] if entry is not None else self.factory(key)
+            self._sessions[key] = (session, now)
+            while len(self._sessions) > self.max_sessions:
+                evicted, _ = self._sessions.popitem(last=False)
+                print(f"补全会话已淘汰: {evicted}")
+            return session
+
+    def clear(self):
+        """配置变化后丢弃所有会话"""
+        with self._lock:
+            self._sessions.clear()
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class LongTextProcessor:
+    """长文本分段处理：切分后并发请求，总结分层归并，翻译按原顺序输出"""
+
+    TRANSLATE_PROMPT = "请将以下文本翻译成中文，只输出译文:\n{text}"
+    MAP_PROMPT = "以下是一篇长文的第{index}/{total}部分，请对这部分内容进行概括总结:\n{text}"
+    REDUCE_PROMPT = "以下是同一篇长文若干部分的总结，请将它们合并为一份连贯、完整的总结:\n{text}"
+
+    def __init__(self, chat_session, chunk_tokens=LONG_TEXT_CHUNK_TOKENS,
+                 max_workers=LONG_TEXT_MAX_WORKERS, temperature=0.7, cancel_token=None):
+        """
+        :param chat_session: 用于发送请求的ChatSession，分段请求不写入其历史记录
+        :param chunk_tokens: 每段的token预算
+        :param max_workers: 最大并发请求数
+        :param temperature: 温度参数
+        :param cancel_token: 取消令牌，取消后进行中的分段立即中断，未开始的分段不再发送
+        """
+        self.cancel_token = cancel_token
+        self.chat_session = chat_session
+        self.chunk_tokens = chunk_tokens
+        self.max_workers = max_workers
+        self.temperature = temperature
+
+    def needs_split(self, text):
+        """文本是否超出单次请求的预算"""
+        return estimate_tokens(text) > self.chunk_tokens
+
+    def split(self, text):
+        return split_text(text, self.chunk_tokens)
+
+    def _run(self, prompts, stage, on_progress=None):
+        """并发发送一组请求，返回按原顺序排列的future列表"""
+        total = len(prompts)
+        done = [0]
+
+        def finished(_):
+            done[0] += 1
+            if on_progress:
+                on_progress(stage, done[0], total)
+
+        executor = ThreadPoolExecutor(max_workers=min(self.max_workers, total))
+        futures = []
+        for prompt in prompts:
+            future = executor.submit(self._ask, prompt)
+            future.add_done_callback(finished)
+            futures.append(future)
+        executor.shutdown(wait=False)
+        return futures
+
+    def _ask(self, prompt):
+        if self.cancel_token and self.cancel_token.cancelled:
+            return None
+        return self.chat_session.ask_once(prompt, self.temperature, cancel_token=self.cancel_token)
+
+    def translate(self, text, on_chunk=None, on_progress=None):
+        """
+        分段并发翻译，按原文顺序逐段回调
+        :param on_chunk: on_chunk(index, total, translated)，前面各段完成后才会回调后面的段
+        :param on_progress: on_progress(stage, done, total)，在工作线程中调用
+        :return: 拼接后的完整译文
+        """
+        chunks = self.split(text)
+        if not chunks:
+            return ""
+        futures = self._run([self.TRANSLATE_PROMPT.format(text=c) for c in chunks], "翻译", on_progress)
+        results = []
+        for i, future in enumerate(futures):
+            translated = future.result() or ""
+            if self.cancel_token and self.cancel_token.cancelled:
+                break
+            results.append(translated)
+            if on_chunk:
+                on_chunk(i, len(chunks), translated)
+        return "\n\n".join(results)
+
+    def summarize(self, text, on_progress=None):
+        """
+        先并发总结各段，再把分段总结按预算分组逐层归并，直到只剩一份
+        :param on_progress: on_progress(stage, done, total)，在工作线程中调用
+        :return: 最终总结，出错时返回错误信息
+        """
+        chunks = self.split(text)
+        if not chunks:
+            return ""
+        total = len(chunks)
+        prompts = [self.MAP_PROMPT.format(index=i + 1, total=total, text=c)
+                   for i, c in enumerate(chunks)]
+        summaries = [f.result() for f in self._run(prompts, "分段总结", on_progress)]
+
+        level = 1
+        while True:
+            if self.cancel_token and self.cancel_token.cancelled:
+                return None
+            for summary in summaries:
+                if is_error_response(summary):
+                    return summary or "\n发生错误: 分段总结返回为空"
+            if len(summaries) == 1 and total == 1:
+                return summaries[0]
+
+            groups = _pack(summaries, self.chunk_tokens, "\n\n")
+            if len(groups) == len(summaries) and len(summaries) > 1:
+                # 单条总结已接近预算时，至少两两合并以保证收敛
+                groups = ["\n\n".join(summaries[i:i + 2]) for i in range(0, len(summaries), 2)]
+            prompts = [self.REDUCE_PROMPT.format(text=g) for g in groups]
+            summaries = [f.result() for f in self._run(prompts, f"第{level}轮归并", on_progress)]
+            level += 1
+            if self.cancel_token and self.cancel_token.cancelled:
+                return None
+            if len(summaries) == 1:
+                summary = summaries[0]
+                return summary if summary else "\n发生错误: 归并总结返回为空"
+
+
+class ModelComparison:
+    """同一个问题同时发给多个模型，各自流式返回，总耗时接近最慢的模型而不是各模型之和"""
+
+    def __init__(self, sessions, temperature=0.7, max_tokens=2000, cancel_token=None):
+        """
+        :param sessions: 参与对比的ChatSession列表，每个模型一个，请求不写入其历史记录
+        :param temperature: 温度参数
+        :param max_tokens: 回复的最大token数量
+        :param cancel_token: 取消令牌，取消后所有模型的请求立即中断
+        """
+        self.sessions = sessions
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.cancel_token = cancel_token
+
+    def _run_one(self, index, prompt, started, on_delta, on_done):
+        session = self.sessions[index]
+        outcome = {}
+        stats = {"model": session.model, "ttft": None, "latency": None,
+                 "prompt_tokens": None, "completion_tokens": None, "error": None}
+        messages = [session.system_prompt, {"role": "user", "content": prompt}]
+        text = []
+        try:
+            for delta in session.stream_messages(messages, self.temperature, self.max_tokens,
+                                                 outcome, self.cancel_token):
+                if stats["ttft"] is None:
+                    stats["ttft"] = time.monotonic() - started
+                text.append(delta)
+                if on_delta:
+                    on_delta(index, delta)
+        except Exception as e:
+            stats["error"] = f"\n发生错误: {str(e)}"
+        stats["latency"] = time.monotonic() - started
+        result = outcome.get("result")
+        if stats["error"] is None and is_error_response(result):
+            stats["error"] = result or "\n发生错误: 返回为空"
+        if stats["error"] is not None:
+            stats["ttft"] = None
+        usage = session.last_usage if stats["error"] is None and result is not None else None
+        if usage:
+            stats["prompt_tokens"] = usage["prompt_tokens"]
+            stats["completion_tokens"] = usage["completion_tokens"]
+        elif text and stats["error"] is None:
+            stats["completion_tokens"] = estimate_tokens("".join(text))
+        if on_done:
+            on_done(index, stats)
+        return stats
+
+    def run(self, prompt, on_delta=None, on_done=None):
+        """
+        并发请求所有模型，阻塞到全部结束
+        :param on_delta: on_delta(index, delta)，在工作线程中调用
+        :param on_done: on_done(index, stats)，某个模型结束时在工作线程中调用
+        :return: 按sessions顺序排列的统计，含 ttft/latency（秒）、prompt_tokens/completion_tokens 和 error
+        """
+        if not self.sessions:
+            return []
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=len(self.sessions)) as executor:
+            futures = [executor.submit(self._run_one, i, prompt, started, on_delta, on_done)
+                       for i in range(len(self.sessions))]
+            results = [f.result() for f in futures]
+        print(f"多模型对比完成: {len(results)}个模型，总耗时{time.monotonic() - started:.2f}s")
+        return results
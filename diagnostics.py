@@ -0,0 +1,124 @@
+"""
+诊断：托盘常驻数周时定位资源泄漏
+按需开启tracemalloc，统计存活的窗口、会话、线程和Tk控件数量，与基线对比后写入报告
+"""
+
+import gc
+import os
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+DIAGNOSTICS_DIR = "diagnostics"
+TRACE_FRAMES = 10
+TOP_ALLOCATIONS = 20
+
+
+def count_instances(cls):
+    """统计仍存活的cls实例数（含子类）"""
+    return sum(1 for obj in gc.get_objects() if isinstance(obj, cls))
+
+
+def count_widgets(widget):
+    """统计widget及其所有子控件的数量，需在界面线程调用"""
+    return 1 + sum(count_widgets(child) for child in widget.winfo_children())
+
+
+class Diagnostics:
+    """资源诊断：登记计数函数，设置基线，生成与基线对比的报告"""
+
+    def __init__(self, report_dir=DIAGNOSTICS_DIR, frames=TRACE_FRAMES):
+        """
+        :param report_dir: 报告保存目录
+        :param frames: tracemalloc记录的调用栈深度
+        """
+        self.report_dir = report_dir
+        self.frames = frames
+        self.probes = {}
+        self.baseline = None
+        self.baseline_time = None
+        self.baseline_snapshot = None
+
+    def add_probe(self, name, func):
+        """登记一项计数，func() 返回当前数量"""
+        self.probes[name] = func
+
+    def counts(self):
+        """当前各项计数，包括线程数和按名称归类的线程"""
+        gc.collect()
+        result = {}
+        for name, func in self.probes.items():
+            try:
+                result[name] = func()
+            except Exception as e:
+                print(f"诊断计数 {name} 失败: {str(e)}")
+                result[name] = -1
+        threads = threading.enumerate()
+        result["线程"] = len(threads)
+        # 线程名去掉编号后归类，如 Thread-12 (worker) -> Thread (worker)
+        for name, count in Counter(_thread_kind(t) for t in threads).items():
+            result[f"线程: {name}"] = count
+        return result
+
+    def set_baseline(self):
+        """开启内存追踪并记录当前状态作为基线"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            print("已开启内存追踪")
+        self.baseline = self.counts()
+        self.baseline_time = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.baseline_snapshot = _snapshot()
+        print(f"诊断基线已记录: {self.baseline_time}")
+
+    def diff(self):
+        """与基线相比各项计数的变化，没有基线时先设置基线"""
+        if self.baseline is None:
+            self.set_baseline()
+        current = self.counts()
+        return {name: (current.get(name, 0), self.baseline.get(name, 0),
+                       current.get(name, 0) - self.baseline.get(name, 0))
+                for name in sorted(set(current) | set(self.baseline))}
+
+    def report(self):
+        """
+        生成与基线对比的报告并写入文件
+        :return: (报告文件路径, 各项计数变化)
+        """
+        changes = self.diff()
+        lines = [f"ChatFree 诊断报告 {time.strftime('%Y-%m-%d %H:%M:%S')}",
+                 f"基线时间: {self.baseline_time}", "",
+                 "计数（当前 / 基线 / 变化）:"]
+        for name, (current, base, delta) in changes.items():
+            lines.append(f"  {name}: {current} / {base} / {delta:+d}")
+
+        if tracemalloc.is_tracing():
+            size, peak = tracemalloc.get_traced_memory()
+            lines += ["", f"追踪内存: 当前 {size / 1024:.1f}KB，峰值 {peak / 1024:.1f}KB",
+                      f"增长最多的{TOP_ALLOCATIONS}处分配:"]
+            for stat in _snapshot().compare_to(self.baseline_snapshot, 'lineno')[:TOP_ALLOCATIONS]:
+                lines.append(f"  {stat}")
+
+        os.makedirs(self.report_dir, exist_ok=True)
+        path = os.path.join(self.report_dir, f"diag-{time.strftime('%Y%m%d-%H%M%S')}.txt")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        print(f"诊断报告已写入: {path}")
+        return path, changes
+
+
+def _snapshot():
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    ))
+
+
+def _thread_kind(thread):
+    name = thread.name
+    if name.startswith("Thread-"):
+        rest = name.split(" ", 1)
+        return "Thread" + (f" {rest[1]}" if len(rest) > 1 else "")
+    return name.rstrip("0123456789_-") or name
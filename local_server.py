@@ -0,0 +1,270 @@
+"""
+本地服务：在localhost上提供OpenAI兼容接口，
+让脚本和编辑器插件复用程序已配置的服务商、提示词、连接池、请求合并和花费上限
+"""
+
+import hmac
+import itertools
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from ai_api import ASSISTANT_PROMPT, BUDGET_EXCEEDED, ChatSession, is_error_response
+
+DEFAULT_PORT = 8765
+MAX_CONCURRENCY = 4
+ALLOWED_HOSTS = ('127.0.0.1', 'localhost')
+
+# 这两个模型名使用程序中的提示词，其余模型名原样转发给服务商
+COMPLETE_ALIAS = "chatfree-complete"
+ASSISTANT_ALIAS = "chatfree-assistant"
+
+
+def _text_of(content):
+    """把多段式content合并为纯文本"""
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content if content is not None else ""
+
+
+class LocalApiServer:
+    """本地OpenAI兼容服务，与程序共用连接池、请求合并和用量统计"""
+
+    def __init__(self, get_config, port=DEFAULT_PORT, token=None, max_concurrency=MAX_CONCURRENCY):
+        """
+        :param get_config: 返回当前配置的函数，需包含 api_key/api_url/model/temperature/custom_prompt
+        :param port: 监听端口，只绑定127.0.0.1
+        :param token: 访问令牌，请求需携带 Authorization: Bearer <token>
+        :param max_concurrency: 同时转发的最大请求数
+        """
+        self.get_config = get_config
+        self.port = port
+        self.token = token
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.httpd = None
+        self.thread = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        server = self
+
+        class Handler(_Handler):
+            owner = server
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        print(f"本地服务已启动: http://127.0.0.1:{self.port}/v1")
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+            self.thread = None
+            print("本地服务已停止")
+
+    def session_for(self, model):
+        """
+        每个请求使用独立的ChatSession，保证返回的usage属于该请求；
+        连接池、请求合并和用量统计在进程内共享
+        """
+        config = self.get_config()
+        return ChatSession(
+            api_key=config['api_key'],
+            base_url=config['api_url'],
+            model=model,
+            system_prompt={"role": "system", "content": ASSISTANT_PROMPT}
+        )
+
+    def resolve(self, body):
+        """解析请求中的模型名和消息，模型别名会加上程序中的提示词"""
+        config = self.get_config()
+        model = body.get("model") or config['model']
+        messages = [{"role": m.get("role", "user"), "content": _text_of(m.get("content"))}
+                    for m in body.get("messages") or []]
+        has_system = any(m["role"] == "system" for m in messages)
+        if model == COMPLETE_ALIAS:
+            model = config['model']
+            if not has_system:
+                messages.insert(0, {"role": "system", "content": config['custom_prompt']})
+        elif model == ASSISTANT_ALIAS:
+            model = config['model']
+            if not has_system:
+                messages.insert(0, {"role": "system", "content": ASSISTANT_PROMPT})
+        return model, messages
+
+
+class _Handler(BaseHTTPRequestHandler):
+    owner = None
+    server_version = "ChatFree"
+
+    def log_message(self, format, *args):
+        print(f"本地服务: {format % args}")
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status, message, error_type="invalid_request_error"):
+        self.send_json(status, {"error": {"message": message, "type": error_type}})
+
+    def send_upstream_error(self, result):
+        """把ChatSession返回的错误信息转为HTTP错误，达到花费上限时返回429"""
+        if result == BUDGET_EXCEEDED:
+            self.send_error_json(429, result, "insufficient_quota")
+        else:
+            self.send_error_json(502, result or "empty response", "upstream_error")
+
+    def authorized(self):
+        """只接受本机Host并校验令牌"""
+        host = (self.headers.get("Host") or "").rsplit(":", 1)[0].strip("[]")
+        if host not in ALLOWED_HOSTS:
+            self.send_error_json(403, "forbidden host")
+            return False
+        auth = self.headers.get("Authorization") or ""
+        token = auth[7:] if auth.startswith("Bearer ") else ""
+        if not self.owner.token or not hmac.compare_digest(token, self.owner.token):
+            self.send_error_json(401, "invalid token", "authentication_error")
+            return False
+        return True
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        if self.path.rstrip('/') != "/v1/models":
+            self.send_error_json(404, "not found")
+            return
+        model = self.owner.get_config()['model']
+        created = int(time.time())
+        self.send_json(200, {
+            "object": "list",
+            "data": [{"id": name, "object": "model", "created": created, "owned_by": "chatfree"}
+                     for name in (model, COMPLETE_ALIAS, ASSISTANT_ALIAS) if name]
+        })
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        if self.path.rstrip('/') != "/v1/chat/completions":
+            self.send_error_json(404, "not found")
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except (ValueError, UnicodeDecodeError):
+            self.send_error_json(400, "invalid json body")
+            return
+        if not isinstance(body, dict):
+            self.send_error_json(400, "request body must be a json object")
+            return
+        messages = body.get("messages")
+        if messages is not None and (not isinstance(messages, list)
+                                     or not all(isinstance(m, dict) for m in messages)):
+            self.send_error_json(400, "messages must be a list of objects")
+            return
+
+        model, messages = self.owner.resolve(body)
+        if not messages:
+            self.send_error_json(400, "messages is required")
+            return
+        temperature = body.get("temperature", self.owner.get_config()['temperature'])
+        max_tokens = body.get("max_tokens") or 2000
+
+        if not self.owner.slots.acquire(timeout=30):
+            self.send_error_json(429, "too many concurrent requests", "rate_limit_error")
+            return
+        try:
+            session = self.owner.session_for(model)
+            if body.get("stream"):
+                self.stream_reply(session, model, messages, temperature, max_tokens)
+            else:
+                self.plain_reply(session, model, messages, temperature, max_tokens)
+        finally:
+            self.owner.slots.release()
+
+    def plain_reply(self, session, model, messages, temperature, max_tokens):
+        result = session.complete_messages(messages, temperature, max_tokens)
+        if is_error_response(result):
+            self.send_upstream_error(result)
+            return
+        usage = session.last_usage or {}
+        self.send_json(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": result},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": usage.get("prompt_tokens", 0),
+                "completion_tokens": usage.get("completion_tokens", 0),
+                "total_tokens": usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0),
+                "prompt_tokens_details": {"cached_tokens": usage.get("cached_tokens", 0)}
+            }
+        })
+
+    def stream_reply(self, session, model, messages, temperature, max_tokens):
+        """
+        以SSE转发增量内容；客户端断开时关闭生成器，上游请求随之中断
+        上游在开始前出错时返回HTTP错误，中途出错时发送SSE错误事件
+        """
+        stream = session.stream_messages(messages, temperature, max_tokens)
+        first = next(stream, None)
+        if first is not None and is_error_response(first):
+            stream.close()
+            self.send_upstream_error(first)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        def send(payload):
+            self.wfile.write(b"data: " + json.dumps(payload, ensure_ascii=False).encode('utf-8') + b"\n\n")
+            self.wfile.flush()
+
+        def event(delta, finish_reason=None):
+            send({
+                "id": chunk_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+            })
+
+        try:
+            event({"role": "assistant", "content": ""})
+            for delta in itertools.chain([first] if first is not None else [], stream):
+                if is_error_response(delta):
+                    send({"error": {"message": delta, "type": "upstream_error"}})
+                    return
+                event({"content": delta})
+            event({}, "stop")
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
+            print("本地服务: 客户端已断开，中断上游请求")
+        finally:
+            stream.close()
@@ -6,11 +6,21 @@ Licensed under the MIT License - see LICENSE file for details
 
 import json
 import os
+import secrets
 import time
+from collections import OrderedDict
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox
 import win32clipboard
-from ai_api import ChatSession
+import win32api
+import win32gui
+import win32process
+from ai_api import (ChatSession, ChatSessionPool, CancelToken, LongTextProcessor, ModelComparison,
+                    SectionParser, ASSISTANT_PROMPT, is_error_response, set_request_compression,
+                    prewarm, prewarm_stats, set_prewarm_budget)
+from usage_stats import usage_tracker
+from local_server import LocalApiServer, DEFAULT_PORT, COMPLETE_ALIAS, ASSISTANT_ALIAS
+from diagnostics import Diagnostics, count_instances, count_widgets
 import pystray
 from PIL import Image
 import threading
@@ -21,7 +31,67 @@ import keyboard
 
 ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID('ChatFree')
 
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+MAX_PROCESS_PATH = 32768
+COMPLETION_MAX_HISTORY = 20
+COMPLETION_MAX_SESSIONS = 16
+COMPLETION_IDLE_TTL = 1800
+# 按选中文本缓存候选补全的条数
+CANDIDATE_CACHE_SIZE = 32
+
+def foreground_window_key():
+    """按前台窗口区分补全上下文，标题去掉编辑器的未保存标记"""
+    hwnd = win32gui.GetForegroundWindow()
+    title = win32gui.GetWindowText(hwnd).lstrip('*● ')
+    return f"window:{hwnd}:{title}"
+
+def foreground_process_key():
+    """按前台窗口所属的程序区分补全上下文"""
+    hwnd = win32gui.GetForegroundWindow()
+    _, pid = win32process.GetWindowThreadProcessId(hwnd)
+    # 只申请受限查询权限，提权运行的程序也能打开；GetModuleFileNameEx还需要读内存的权限，
+    # 这里改用QueryFullProcessImageNameW
+    handle = win32api.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+    try:
+        size = ctypes.c_ulong(MAX_PROCESS_PATH)
+        path = ctypes.create_unicode_buffer(size.value)
+        if not ctypes.windll.kernel32.QueryFullProcessImageNameW(int(handle), 0, path, ctypes.byref(size)):
+            raise ctypes.WinError()
+        return f"process:{path.value.lower()}"
+    finally:
+        win32api.CloseHandle(handle)
+
+# 补全上下文的划分方式，可按需增加
+COMPLETION_CONTEXT_KEYS = {
+    "window": foreground_window_key,
+    "process": foreground_process_key,
+    "global": lambda: "global"
+}
+COMPLETION_CONTEXT_NAMES = {
+    "window": "按窗口",
+    "process": "按程序",
+    "global": "全局"
+}
+
 class DialogWindow:
+    # 文本框中最多保留的消息条数，更早的消息只保存在transcript中，滚动到顶部时再按页渲染
+    SCROLLBACK_LIMIT = 200
+    SCROLLBACK_PAGE = 20
+    
+    ROLE_TAGS = {
+        "系统": "system",
+        "AI": "ai", 
+        "用户": "user",
+        "文本": "text"
+    }
+    
+    # 合并请求中各操作的要求，回复按【标题】分段
+    COMBINED_ACTIONS = {
+        "翻译": "翻译成中文",
+        "解释": "解释其含义",
+        "总结": "概括总结"
+    }
+    
     def __init__(self, parent, selected_text=None, config=None):
         self.dialog = tk.Toplevel(parent)
         self.dialog.title("AI 助手")
@@ -36,7 +106,7 @@ class DialogWindow:
             api_key=config['api_key'],
             base_url=config['api_url'],
             model=config['model'],
-            system_prompt={"role": "system", "content": "你是一个智能AI助手。"}
+            system_prompt={"role": "system", "content": ASSISTANT_PROMPT}
         )
         
         self.txt_history = scrolledtext.ScrolledText(self.dialog, height=12)
@@ -80,9 +150,19 @@ class DialogWindow:
         
         self.txt_history.configure(
             background='#FAFAFA', 
-            font=('Microsoft YaHei', 10) 
+            font=('Microsoft YaHei', 10),
+            yscrollcommand=self.on_history_scroll
         )
         
+        self.transcript = []
+        self.rendered_start = 0
+        self.rendered_end = 0
+        self.paging = False
+        
+        self.request_token = None
+        self.streaming_index = None
+        self.dialog.protocol("WM_DELETE_WINDOW", self.close)
+        
         self.txt_input = scrolledtext.ScrolledText(self.dialog, height=8)
         self.txt_input.pack(fill='x', padx=10, pady=5)
         
@@ -100,9 +180,18 @@ class DialogWindow:
         self.btn_summarize = ttk.Button(btn_frame, text="总结", command=self.summarize)
         self.btn_summarize.pack(side='left', padx=5)
         
+        self.btn_combined = ttk.Button(btn_frame, text="全部", command=self.combined)
+        self.btn_combined.pack(side='left', padx=5)
+        
         self.btn_ask = ttk.Button(btn_frame, text="询问", command=self.ask)
         self.btn_ask.pack(side='left', padx=5)
         
+        self.btn_compare = ttk.Button(btn_frame, text="对比", command=self.compare)
+        self.btn_compare.pack(side='left', padx=5)
+        
+        self.lbl_status = ttk.Label(btn_frame, text="", foreground='#666666')
+        self.lbl_status.pack(side='right', padx=5)
+        
         if selected_text:
             self.append_message("系统", "您选中的文本是:")
             self.append_message("文本", selected_text)
@@ -111,6 +200,7 @@ class DialogWindow:
             self.btn_translate['state'] = 'disabled'
             self.btn_explain['state'] = 'disabled'
             self.btn_summarize['state'] = 'disabled'
+            self.btn_combined['state'] = 'disabled'
             self.append_message("系统", "您没有选中任何文本。")
             self.append_message("系统", "您可以直接在下方输入框中提问。")
             
@@ -127,43 +217,128 @@ class DialogWindow:
             self.send_message()
             return 'break'
             
-    def append_message(self, role, content, stream=False):
+    def append_message(self, role, content):
         """添加消息到历史记录"""
-        tag = {
-            "系统": "system",
-            "AI": "ai", 
-            "用户": "user",
-            "文本": "text"
-        }.get(role, None)
-        
-        if not stream:
-            if tag and tag != "text":
-                self.txt_history.insert('end', '\n')
-                self.txt_history.insert('end', f"{role}: {content}\n", tag)
-            else:
-                self.txt_history.insert('end', '\n')
-                self.txt_history.insert('end', f"{content}\n", "text")
-            self.txt_history.see('end')
-        else:
-            if tag and tag != "text":
-                self.txt_history.insert('end', '\n')
-                self.txt_history.insert('end', f"{role}: ", tag)
-                for char in content:
-                    self.txt_history.insert('end', char, tag)
-                    self.txt_history.see('end')
-                    self.dialog.update()
-                    time.sleep(0.01)
-                self.txt_history.insert('end', '\n')
-            else:
-                self.txt_history.insert('end', '\n')
-                for char in content:
-                    self.txt_history.insert('end', char, "text")
-                    self.txt_history.see('end')
-                    self.dialog.update()
-                    time.sleep(0.01)
-                self.txt_history.insert('end', '\n')
+        if self.rendered_end < len(self.transcript):
+            self.render_latest()
+        
+        index = len(self.transcript)
+        self.transcript.append((role, content))
+        self.txt_history.mark_set(f"msg{index}", 'end-1c')
+        self.txt_history.mark_gravity(f"msg{index}", 'left')
+        self.rendered_end = index + 1
+        
+        self.txt_history.insert('end', *self.message_segments(role, content))
+        self.txt_history.see('end')
+        
+        while self.rendered_end - self.rendered_start > self.SCROLLBACK_LIMIT:
+            self.trim_top()
+    
+    def begin_message(self, role):
+        """开始一条流式消息，内容随后由extend_message逐段追加"""
+        self.append_message(role, "")
+        self.streaming_index = len(self.transcript) - 1
+    
+    def extend_message(self, delta):
+        """向正在流式显示的消息追加内容"""
+        index = self.streaming_index
+        if index is None:
+            return
+        role, content = self.transcript[index]
+        self.transcript[index] = (role, content + delta)
+        if index == len(self.transcript) - 1 and self.rendered_end == len(self.transcript):
+            # 消息末尾的换行之前
+            self.txt_history.insert('end-2c', delta, self.ROLE_TAGS.get(role, "text"))
             self.txt_history.see('end')
     
+    def message_segments(self, role, content):
+        """消息在文本框中的(文本, 标签)片段，供Text.insert一次插入"""
+        tag = self.ROLE_TAGS.get(role, None)
+        if tag and tag != "text":
+            return ('\n', (), f"{role}: {content}\n", tag)
+        return ('\n', (), f"{content}\n", "text")
+    
+    def render_at_top(self, index):
+        """把第index条消息插入到文本框顶部"""
+        role, content = self.transcript[index]
+        # 左引力的msg标记会停在插入内容之前，用右引力的临时标记找回原首条消息的起点
+        self.txt_history.mark_set('page_anchor', '1.0')
+        self.txt_history.insert('1.0', *self.message_segments(role, content))
+        self.txt_history.mark_set(f"msg{index}", '1.0')
+        self.txt_history.mark_gravity(f"msg{index}", 'left')
+        if index + 1 < self.rendered_end:
+            self.txt_history.mark_set(f"msg{index + 1}", 'page_anchor')
+    
+    def render_at_bottom(self, index):
+        """把第index条消息追加到文本框末尾"""
+        role, content = self.transcript[index]
+        self.txt_history.mark_set(f"msg{index}", 'end-1c')
+        self.txt_history.mark_gravity(f"msg{index}", 'left')
+        self.txt_history.insert('end', *self.message_segments(role, content))
+    
+    def trim_top(self):
+        """移除最早渲染的一条消息，内容仍保留在transcript中"""
+        self.txt_history.delete('1.0', f"msg{self.rendered_start + 1}")
+        self.txt_history.mark_unset(f"msg{self.rendered_start}")
+        self.rendered_start += 1
+    
+    def trim_bottom(self):
+        """移除最后渲染的一条消息"""
+        self.rendered_end -= 1
+        self.txt_history.delete(f"msg{self.rendered_end}", 'end')
+        self.txt_history.mark_unset(f"msg{self.rendered_end}")
+    
+    def render_latest(self):
+        """回到最新的消息：清空文本框，只渲染最后SCROLLBACK_LIMIT条"""
+        for index in range(self.rendered_start, self.rendered_end):
+            self.txt_history.mark_unset(f"msg{index}")
+        self.txt_history.delete('1.0', 'end')
+        self.rendered_start = max(0, len(self.transcript) - self.SCROLLBACK_LIMIT)
+        self.rendered_end = self.rendered_start
+        for index in range(self.rendered_start, len(self.transcript)):
+            self.render_at_bottom(index)
+            self.rendered_end = index + 1
+    
+    def on_history_scroll(self, first, last):
+        """滚动到顶部或底部时按页补渲染已移出文本框的消息"""
+        self.txt_history.vbar.set(first, last)
+        if self.paging:
+            return
+        if float(first) <= 0.0 and self.rendered_start > 0:
+            self.paging = True
+            self.dialog.after_idle(self.load_older)
+        elif float(last) >= 1.0 and self.rendered_end < len(self.transcript):
+            self.paging = True
+            self.dialog.after_idle(self.load_newer)
+    
+    def load_older(self):
+        """向上翻页：在顶部补渲染更早的消息，并从底部移除同样数量"""
+        try:
+            self.txt_history.mark_set('view_anchor', '@0,0')
+            count = min(self.SCROLLBACK_PAGE, self.rendered_start)
+            for index in range(self.rendered_start - 1, self.rendered_start - count - 1, -1):
+                self.render_at_top(index)
+            self.rendered_start -= count
+            while self.rendered_end - self.rendered_start > self.SCROLLBACK_LIMIT:
+                self.trim_bottom()
+            self.txt_history.yview('view_anchor')
+        finally:
+            self.paging = False
+    
+    def load_newer(self):
+        """向下翻页：在底部补渲染较新的消息，并从顶部移除同样数量"""
+        try:
+            self.txt_history.mark_set('view_anchor', '@0,0')
+            count = min(self.SCROLLBACK_PAGE, len(self.transcript) - self.rendered_end)
+            for index in range(self.rendered_end, self.rendered_end + count):
+                self.render_at_bottom(index)
+                self.rendered_end = index + 1
+            while self.rendered_end - self.rendered_start > self.SCROLLBACK_LIMIT:
+                self.trim_top()
+            self.txt_history.yview('view_anchor')
+        finally:
+            self.paging = False
+    
     def send_message(self):
         """发送消息"""
         user_input = self.txt_input.get('1.0', 'end-1c').strip()
@@ -173,9 +348,7 @@ class DialogWindow:
         self.append_message("用户", user_input)
         self.txt_input.delete('1.0', 'end')
         
-        response = self.chat_session.chat(user_input, temperature=self.config['temperature'])
-        if response:
-            self.append_message("AI", response, stream=True)
+        self.stream_reply(user_input, temperature=self.config['temperature'])
     
     def translate(self):
         """翻译功能"""
@@ -186,9 +359,11 @@ class DialogWindow:
         self.append_message("用户", "请求翻译:")
         # self.append_message("文本", self.selected_text)
         
-        response = self.chat_session.chat(prompt)
-        if response:
-            self.append_message("AI", response, stream=True)
+        if self.long_text_processor().needs_split(self.selected_text):
+            self.process_long_text("translate")
+            return
+        
+        self.stream_reply(prompt)
     
     def explain(self):
         """解释功能"""
@@ -199,9 +374,7 @@ class DialogWindow:
         self.append_message("用户", "请求解释:")
         # self.append_message("文本", self.selected_text)
         
-        response = self.chat_session.chat(prompt)
-        if response:
-            self.append_message("AI", response, stream=True)
+        self.stream_reply(prompt)
     
     def summarize(self):
         """总结功能"""
@@ -212,9 +385,141 @@ class DialogWindow:
         self.append_message("用户", "请求总结:")
         # self.append_message("文本", self.selected_text)
         
-        response = self.chat_session.chat(prompt)
-        if response:
-            self.append_message("AI", response, stream=True)
+        if self.long_text_processor().needs_split(self.selected_text):
+            self.process_long_text("summarize")
+            return
+        
+        self.stream_reply(prompt)
+    
+    def combined(self):
+        """把尚未执行的翻译、解释、总结合并为一次请求，选中文本只发送一次，回复实时分段显示"""
+        if not self.selected_text:
+            return
+        buttons = {"翻译": self.btn_translate, "解释": self.btn_explain, "总结": self.btn_summarize}
+        titles = [title for title in self.COMBINED_ACTIONS if str(buttons[title]['state']) != 'disabled']
+        if not titles:
+            return
+        if self.long_text_processor().needs_split(self.selected_text):
+            self.append_message("系统", "文本较长，请分别使用翻译和总结。")
+            return
+        for title in titles:
+            buttons[title]['state'] = 'disabled'
+        self.btn_combined['state'] = 'disabled'
+        
+        tasks = "、".join(self.COMBINED_ACTIONS[title] for title in titles)
+        markers = "".join(f"【{title}】" for title in titles)
+        prompt = (f"请对以下文本依次完成：{tasks}。\n"
+                  f"按顺序输出，每部分以单独一行的{markers}开头，不要输出其他内容。\n"
+                  f"文本:\n{self.selected_text}")
+        self.append_message("用户", f"请求{'、'.join(titles)}:")
+        self.stream_sections(prompt, titles)
+    
+    def new_request(self):
+        """取消进行中的请求，并为新请求创建取消令牌"""
+        self.cancel_request()
+        self.request_token = CancelToken()
+        return self.request_token
+    
+    def cancel_request(self):
+        if self.request_token and not self.request_token.cancelled:
+            self.request_token.cancel()
+            self.set_status("已取消")
+        self.streaming_index = None
+    
+    def close(self):
+        """关闭窗口时中断进行中的请求"""
+        self.cancel_request()
+        self.dialog.destroy()
+    
+    def stream_reply(self, prompt, temperature=0.7):
+        """在后台线程流式请求，回复逐段显示；新请求或关闭窗口会立即中断进行中的请求"""
+        token = self.new_request()
+        self.begin_message("AI")
+        
+        def show(delta):
+            if self.request_token is token:
+                self.extend_message(delta)
+        
+        def worker():
+            for delta in self.chat_session.chat_stream(prompt, temperature=temperature, cancel_token=token):
+                self.run_in_ui(lambda d=delta: show(d))
+        
+        threading.Thread(target=worker, daemon=True).start()
+    
+    def stream_sections(self, prompt, titles, temperature=0.7):
+        """流式请求分段回复，每遇到一个【标题】就在对话框中开始一条新消息"""
+        token = self.new_request()
+        parser = SectionParser(titles)
+        shown = {"started": False, "title": None}
+        
+        def show(events):
+            if self.request_token is not token:
+                return
+            for title, text in events:
+                if not shown["started"] or title != shown["title"]:
+                    shown["started"] = True
+                    shown["title"] = title
+                    self.begin_message("AI")
+                    if title:
+                        self.extend_message(f"【{title}】\n")
+                self.extend_message(text)
+        
+        def worker():
+            for delta in self.chat_session.chat_stream(prompt, temperature=temperature, cancel_token=token):
+                events = parser.feed(delta)
+                if events:
+                    self.run_in_ui(lambda e=events: show(e))
+            self.run_in_ui(lambda: show(parser.flush()))
+        
+        threading.Thread(target=worker, daemon=True).start()
+    
+    def long_text_processor(self, cancel_token=None):
+        return LongTextProcessor(self.chat_session, temperature=self.config['temperature'],
+                                 cancel_token=cancel_token)
+    
+    def run_in_ui(self, func):
+        """从工作线程切回界面线程执行，窗口已关闭时忽略"""
+        try:
+            self.dialog.after(0, func)
+        except (tk.TclError, RuntimeError):
+            pass
+    
+    def set_status(self, text):
+        if self.dialog.winfo_exists():
+            self.lbl_status['text'] = text
+    
+    def process_long_text(self, task):
+        """长文本分段并发处理，翻译按顺序逐段显示，总结分层归并后显示"""
+        token = self.new_request()
+        processor = self.long_text_processor(token)
+        total = len(processor.split(self.selected_text))
+        self.append_message("系统", f"文本较长，已切分为{total}段并发处理。")
+        
+        def in_ui(func):
+            self.run_in_ui(lambda: func() if self.request_token is token else None)
+        
+        def on_progress(stage, done, count):
+            in_ui(lambda: self.set_status(f"{stage}: {done}/{count}"))
+        
+        def on_chunk(index, count, translated):
+            in_ui(lambda: self.append_message("AI", translated))
+        
+        def worker():
+            if task == "translate":
+                processor.translate(self.selected_text, on_chunk=on_chunk, on_progress=on_progress)
+                in_ui(lambda: self.set_status("翻译完成"))
+            else:
+                summary = processor.summarize(self.selected_text, on_progress=on_progress)
+                if token.cancelled:
+                    return
+                if summary and not is_error_response(summary):
+                    # 只把总结写入历史，方便后续追问，原文过长不放入上下文
+                    self.chat_session.add_to_history({"role": "user", "content": "请对我选中的文本进行概括总结"})
+                    self.chat_session.add_to_history({"role": "assistant", "content": summary})
+                in_ui(lambda: self.append_message("AI", summary or ""))
+                in_ui(lambda: self.set_status("总结完成"))
+        
+        threading.Thread(target=worker, daemon=True).start()
     
     def ask(self):
         """询问功能"""
@@ -225,11 +530,136 @@ class DialogWindow:
         prompt = f"关于文本: {self.selected_text}\n问题: {user_input}"
         self.append_message("用户", f"问题: {user_input}")
         
-        response = self.chat_session.chat(prompt)
-        if response:
-            self.append_message("AI", response, stream=True)
+        self.stream_reply(prompt)
         
         self.txt_input.delete('1.0', 'end')
+    
+    def compare(self):
+        """把输入框中的问题同时发给设置中的多个对比模型，在新窗口中并排显示"""
+        targets = self.config.get('compare_models') or []
+        if not targets:
+            messagebox.showinfo("提示", "请先在设置中填写对比模型", parent=self.dialog)
+            return
+        user_input = self.txt_input.get('1.0', 'end-1c').strip()
+        if not user_input:
+            return
+        prompt = f"关于文本: {self.selected_text}\n问题: {user_input}" if self.selected_text else user_input
+        CompareWindow(self.dialog, prompt, self.config)
+        self.txt_input.delete('1.0', 'end')
+
+
+class CompareWindow:
+    """多模型对比窗口：每个模型一栏，各自流式显示回复，并标注首字耗时、总耗时和token数"""
+    
+    def __init__(self, parent, prompt, config):
+        self.dialog = tk.Toplevel(parent)
+        self.dialog.title("多模型对比")
+        self.dialog.minsize(400, 300)
+        self.dialog.attributes('-topmost', True)
+        self.dialog.protocol("WM_DELETE_WINDOW", self.close)
+        
+        self.sessions = [self.session_for(target, config) for target in config['compare_models']]
+        self.dialog.geometry(f"{min(300 * len(self.sessions), 1500)}x500")
+        
+        lbl_prompt = ttk.Label(self.dialog, text=prompt if len(prompt) <= 200 else prompt[:200] + "…",
+                               wraplength=1000, justify='left', foreground='#004D26')
+        lbl_prompt.pack(fill='x', padx=10, pady=5)
+        
+        panes = ttk.PanedWindow(self.dialog, orient='horizontal')
+        panes.pack(fill='both', expand=True, padx=10, pady=5)
+        
+        self.labels = []
+        self.texts = []
+        for session in self.sessions:
+            frame = ttk.Frame(panes)
+            ttk.Label(frame, text=session.model, font=('Microsoft YaHei', 10, 'bold')).pack(anchor='w')
+            label = ttk.Label(frame, text="等待首字…", foreground='#666666')
+            label.pack(anchor='w')
+            text = scrolledtext.ScrolledText(frame, width=30, wrap='word',
+                                             background='#FAFAFA', font=('Microsoft YaHei', 10))
+            text.pack(fill='both', expand=True)
+            panes.add(frame, weight=1)
+            self.labels.append(label)
+            self.texts.append(text)
+        
+        self.lbl_status = ttk.Label(self.dialog, text="", foreground='#666666')
+        self.lbl_status.pack(anchor='e', padx=10, pady=(0,5))
+        
+        self.token = CancelToken()
+        # 助手窗口关闭时会连带销毁本窗口而不经过close，在这里同样中断请求
+        self.dialog.bind('<Destroy>', self.on_destroy)
+        self.comparison = ModelComparison(self.sessions, temperature=config['temperature'],
+                                          cancel_token=self.token)
+        threading.Thread(target=self.worker, args=(prompt,), daemon=True).start()
+    
+    @staticmethod
+    def session_for(target, config):
+        """对比目标可以是当前服务商的模型名，也可以是含 api_url/api_key/model 的字典以对比其他服务商"""
+        if isinstance(target, dict):
+            api_key, api_url, model = (target.get('api_key', config['api_key']),
+                                       target.get('api_url', config['api_url']), target['model'])
+        else:
+            api_key, api_url, model = config['api_key'], config['api_url'], target
+        return ChatSession(
+            api_key=api_key,
+            base_url=api_url,
+            model=model,
+            system_prompt={"role": "system", "content": ASSISTANT_PROMPT}
+        )
+    
+    def worker(self, prompt):
+        started = time.monotonic()
+        
+        def on_delta(index, delta):
+            self.run_in_ui(lambda: self.show_delta(index, delta))
+        
+        def on_done(index, stats):
+            self.run_in_ui(lambda: self.show_stats(index, stats))
+        
+        self.run_in_ui(lambda: self.set_status(f"正在请求{len(self.sessions)}个模型…"))
+        self.comparison.run(prompt, on_delta=on_delta, on_done=on_done)
+        elapsed = time.monotonic() - started
+        self.run_in_ui(lambda: self.set_status(f"全部完成，总耗时 {elapsed:.2f}s"))
+    
+    def show_delta(self, index, delta):
+        text = self.texts[index]
+        text.insert('end', delta)
+        text.see('end')
+        if self.labels[index]['text'] == "等待首字…":
+            self.labels[index]['text'] = "生成中…"
+    
+    def show_stats(self, index, stats):
+        fmt = lambda v: f"{v:.2f}s" if v is not None else "-"
+        count = lambda v: v if v is not None else "-"
+        if stats['error']:
+            state = "出错"
+        else:
+            state = f"首字 {fmt(stats['ttft'])}"
+        self.labels[index]['text'] = (f"{state} | 总耗时 {fmt(stats['latency'])} | "
+                                      f"输入 {count(stats['prompt_tokens'])} 输出 {count(stats['completion_tokens'])}")
+    
+    def run_in_ui(self, func):
+        """从工作线程切回界面线程执行，窗口已关闭时忽略"""
+        def guarded():
+            if not self.token.cancelled:
+                func()
+        try:
+            self.dialog.after(0, guarded)
+        except (tk.TclError, RuntimeError):
+            pass
+    
+    def set_status(self, text):
+        self.lbl_status['text'] = text
+    
+    def on_destroy(self, event):
+        # 子控件销毁时也会触发，只处理窗口本身
+        if event.widget is self.dialog and not self.token.cancelled:
+            self.token.cancel()
+    
+    def close(self):
+        """关闭窗口时中断所有模型的请求"""
+        self.token.cancel()
+        self.dialog.destroy()
 
 class ChatFreeApp:
     def __init__(self, master):
@@ -268,6 +698,7 @@ class ChatFreeApp:
         
         self.config_file = "config.json"
         self.load_config()
+        prewarm(self.base_url, "启动")
         self.chat_session = None
         self.master.minsize(400, 600)
         
@@ -294,18 +725,20 @@ class ChatFreeApp:
         completion_text = f"""• 选择文本: 在任意编辑器中选中需要续写的文本
 • 快捷键: 按下 {self.hotkey} 开始智能补全长按Ctrl键终止补全
 • 补全过程: 支持自定义Prompt，自由定义风格、字数等
-• 历史记录: 可在设置中选择是否记住补全历史"""
+• 历史记录: 可在设置中选择是否记住补全历史
+• 候选补全: 候选数大于1时按 {self.cycle_hotkey} 切换候选"""
         ttk.Label(usage_frame, text=completion_text, justify='left').pack(anchor='w', padx=30, pady=(0,10))
 
         ttk.Label(usage_frame, text="2. AI助手:", font=("Arial", 10, "bold")).pack(anchor='w', padx=10, pady=(5,0))
         assistant_text = f"""• 快捷键: 按下 {self.assistant_hotkey} 呼出AI助手窗口
 • 助理模式:
   - 选中文本后呼出助手
-  - 可使用翻译、解释和总结功能
+  - 可使用翻译、解释和总结功能，全部可一次请求完成
 • 对话模式:
   - 直接呼出助手进行自由对话
   - 支持连续对话，保持上下文
-  - 询问或者输入框回车发送消息"""
+  - 询问或者输入框回车发送消息
+• 对比模式: 点击对比，同一问题并发发给多个模型"""
         ttk.Label(usage_frame, text=assistant_text, justify='left').pack(anchor='w', padx=30, pady=(0,10))
         
         info_frame = ttk.LabelFrame(main_frame, text="项目信息")
@@ -377,6 +810,15 @@ class ChatFreeApp:
         refresh_btn.pack(side='left')
         self.update_models()
         
+        ttk.Label(api_frame, text="对比模型(逗号分隔，用于助手窗口的多模型对比):").pack(anchor='w')
+        self.ent_compare_models = ttk.Entry(api_frame, width=52)
+        self.ent_compare_models.insert(0, ", ".join(m for m in self.compare_models if isinstance(m, str)))
+        self.ent_compare_models.pack(pady=(0,5))
+        
+        self.compress_requests_var = tk.BooleanVar(value=self.compress_requests)
+        ttk.Checkbutton(api_frame, text="压缩请求体(gzip，节省流量)", 
+                        variable=self.compress_requests_var).pack(anchor='w', padx=15, pady=(0,5))
+        
         hotkey_frame = ttk.LabelFrame(settings_frame, text="快捷键设置")
         hotkey_frame.pack(fill='x', padx=10, pady=5)
         
@@ -390,11 +832,27 @@ class ChatFreeApp:
         self.ent_assistant_hotkey.insert(0, self.assistant_hotkey)
         self.ent_assistant_hotkey.pack(pady=(0,5))
         
+        ttk.Label(hotkey_frame, text="切换候选快捷键:").pack(anchor='w')
+        self.ent_cycle_hotkey = ttk.Entry(hotkey_frame, width=52)
+        self.ent_cycle_hotkey.insert(0, self.cycle_hotkey)
+        self.ent_cycle_hotkey.pack(pady=(0,5))
+        
         completion_frame = ttk.LabelFrame(settings_frame, text="补全设置")
         completion_frame.pack(fill='both', expand=True, padx=10, pady=5)
         
+        history_frame = ttk.Frame(completion_frame)
+        history_frame.pack(fill='x')
         self.keep_history_var = tk.BooleanVar(value=self.keep_history)
-        ttk.Checkbutton(completion_frame, text="记住历史对话", variable=self.keep_history_var).pack(anchor='w', padx=5, pady=5)
+        ttk.Checkbutton(history_frame, text="记住历史对话", variable=self.keep_history_var).pack(side='left', padx=5, pady=5)
+        self.cmb_completion_context = ttk.Combobox(history_frame, width=8, state='readonly',
+                                                   values=list(COMPLETION_CONTEXT_NAMES.values()))
+        self.cmb_completion_context.set(COMPLETION_CONTEXT_NAMES.get(self.completion_context, "按窗口"))
+        self.cmb_completion_context.pack(side='right', padx=5)
+        ttk.Label(history_frame, text="上下文范围:").pack(side='right')
+        self.cmb_candidates = ttk.Combobox(history_frame, width=3, state='readonly', values=[1, 2, 3, 4, 5])
+        self.cmb_candidates.set(self.completion_candidates)
+        self.cmb_candidates.pack(side='right', padx=5)
+        ttk.Label(history_frame, text="候选数:").pack(side='right')
         
         ttk.Label(completion_frame, text="自定义Prompt:").pack(anchor='w', padx=5)
         self.txt_prompt = scrolledtext.ScrolledText(completion_frame, width=50, height=10)
@@ -404,22 +862,234 @@ class ChatFreeApp:
         self.btn_submit = ttk.Button(settings_frame, text="保存设置", command=self.submit)
         self.btn_submit.pack(pady=10)
         
+        usage_frame = ttk.Frame(self.notebook)
+        self.notebook.add(usage_frame, text='用量')
+        self.setup_usage_tab(usage_frame)
+        
+        server_frame = ttk.Frame(self.notebook)
+        self.notebook.add(server_frame, text='本地服务')
+        self.setup_server_tab(server_frame)
+        
         self.master.protocol("WM_DELETE_WINDOW", self.on_closing)
         
+        self.completion_sessions = ChatSessionPool(
+            self.new_completion_session,
+            max_sessions=COMPLETION_MAX_SESSIONS,
+            idle_ttl=COMPLETION_IDLE_TTL
+        )
+        
+        self.completion_token = None
+        self.completion_lock = threading.Lock()
+        
+        self.candidate_cache = OrderedDict()
+        self.last_injection = None
+        
+        self.keyboard_controller = pynput_keyboard.Controller()
         self.keyboard_listener = None
         self.current_keys = set()
         self.setup_keyboard_listener()
         
+        self.diagnostics = Diagnostics()
+        self.diagnostics.add_probe("助手窗口", lambda: count_instances(DialogWindow))
+        self.diagnostics.add_probe("对比窗口", lambda: count_instances(CompareWindow))
+        self.diagnostics.add_probe("会话", lambda: count_instances(ChatSession))
+        self.diagnostics.add_probe("补全会话池", lambda: len(self.completion_sessions))
+        self.diagnostics.add_probe("Tk控件", lambda: count_widgets(self.master))
+        
+        self.local_server = None
+        self.apply_local_server()
+        
+    def setup_usage_tab(self, usage_frame):
+        """用量页：按服务商和模型显示token、花费和p50/p95耗时"""
+        stats_frame = ttk.LabelFrame(usage_frame, text="用量统计")
+        stats_frame.pack(fill='both', expand=True, padx=10, pady=5)
+        
+        columns = ('requests', 'prompt', 'cached', 'completion', 'cost', 'p50', 'p95')
+        self.tree_usage = ttk.Treeview(stats_frame, columns=columns, height=16)
+        self.tree_usage.heading('#0', text='服务商/模型')
+        self.tree_usage.column('#0', width=110)
+        for col, text, width in (('requests', '请求', 36), ('prompt', '输入', 50), ('cached', '缓存', 46),
+                                 ('completion', '输出', 46), ('cost', '花费$', 46),
+                                 ('p50', 'p50', 38), ('p95', 'p95', 38)):
+            self.tree_usage.heading(col, text=text)
+            self.tree_usage.column(col, width=width, anchor='e')
+        self.tree_usage.pack(fill='both', expand=True, padx=5, pady=5)
+        
+        self.lbl_usage_total = ttk.Label(stats_frame, text="")
+        self.lbl_usage_total.pack(anchor='w', padx=5)
+        ttk.Button(stats_frame, text="刷新", command=self.refresh_usage).pack(pady=5)
+        
+        budget_frame = ttk.LabelFrame(usage_frame, text="花费上限")
+        budget_frame.pack(fill='x', padx=10, pady=5)
+        ttk.Label(budget_frame, text="每日花费上限(美元，0为不限):").pack(side='left', padx=5, pady=5)
+        self.ent_daily_budget = ttk.Entry(budget_frame, width=10)
+        self.ent_daily_budget.insert(0, str(self.daily_budget))
+        self.ent_daily_budget.pack(side='left', padx=5)
+        self.btn_budget = ttk.Button(budget_frame, text="保存", width=6, command=self.save_budget)
+        self.btn_budget.pack(side='left', padx=5)
+        
+        prewarm_frame = ttk.LabelFrame(usage_frame, text="连接预热")
+        prewarm_frame.pack(fill='x', padx=10, pady=5)
+        ttk.Label(prewarm_frame, text="每小时最多预热次数(0为关闭):").pack(side='left', padx=5, pady=5)
+        self.ent_prewarm_budget = ttk.Entry(prewarm_frame, width=10)
+        self.ent_prewarm_budget.insert(0, str(self.prewarm_budget))
+        self.ent_prewarm_budget.pack(side='left', padx=5)
+        self.btn_prewarm = ttk.Button(prewarm_frame, text="保存", width=6, command=self.save_prewarm_budget)
+        self.btn_prewarm.pack(side='left', padx=5)
+        
+        self.refresh_usage()
+        
+    def refresh_usage(self):
+        """刷新用量统计"""
+        self.tree_usage.delete(*self.tree_usage.get_children())
+        providers = {}
+        total_cost = 0.0
+        tokens_saved = 0
+        latency = lambda v: f"{v:.2f}" if v is not None else "-"
+        for row in usage_tracker.summary():
+            parent = providers.get(row['provider'])
+            if parent is None:
+                parent = self.tree_usage.insert('', 'end', text=row['provider'], open=True)
+                providers[row['provider']] = parent
+            self.tree_usage.insert(parent, 'end', text=row['model'], values=(
+                row['requests'], row['prompt_tokens'], row['cached_tokens'], row['completion_tokens'],
+                f"{row['cost']:.4f}" if row['priced'] else "?", latency(row['p50']), latency(row['p95'])
+            ))
+            total_cost += row['cost']
+            tokens_saved += row['tokens_saved']
+        warm = prewarm_stats()
+        self.lbl_usage_total['text'] = (f"今日花费: ${usage_tracker.today_cost():.4f}    累计花费: ${total_cost:.4f}\n"
+                                        f"中途取消约节省 {tokens_saved} 个输出token\n"
+                                        f"连接预热 {warm['warmups']} 次，{warm['hits']} 个请求免去建连，"
+                                        f"约节省 {warm['saved_seconds']:.2f}s")
+        unpriced = usage_tracker.unpriced_today()
+        if unpriced:
+            self.lbl_usage_total['text'] += (f"\n今日未定价模型: {', '.join(unpriced)}（花费按0计，不计入每日上限，"
+                                             f"可在config.json的model_prices中填写价格）")
+        
+    def save_budget(self):
+        """保存每日花费上限"""
+        try:
+            self.daily_budget = max(float(self.ent_daily_budget.get()), 0.0)
+        except ValueError:
+            messagebox.showwarning("警告", "请输入有效的数字")
+            return
+        usage_tracker.daily_cap = self.daily_budget
+        self.save_config()
+        self.btn_budget["text"] = "已保存"
+        self.master.after(700, lambda: self.btn_budget.configure(text="保存"))
+        
+    def save_prewarm_budget(self):
+        """保存每小时预热次数"""
+        try:
+            self.prewarm_budget = max(int(self.ent_prewarm_budget.get()), 0)
+        except ValueError:
+            messagebox.showwarning("警告", "请输入有效的整数")
+            return
+        set_prewarm_budget(self.prewarm_budget)
+        self.save_config()
+        self.btn_prewarm["text"] = "已保存"
+        self.master.after(700, lambda: self.btn_prewarm.configure(text="保存"))
+        
+    def setup_server_tab(self, server_frame):
+        """本地服务页：在localhost提供OpenAI兼容接口"""
+        option_frame = ttk.LabelFrame(server_frame, text="本地服务")
+        option_frame.pack(fill='x', padx=10, pady=5)
+        
+        self.local_server_var = tk.BooleanVar(value=self.local_server_enabled)
+        ttk.Checkbutton(option_frame, text="启用本地OpenAI兼容接口", 
+                        variable=self.local_server_var).pack(anchor='w', padx=5, pady=5)
+        
+        ttk.Label(option_frame, text="端口:").pack(anchor='w', padx=5)
+        self.ent_server_port = ttk.Entry(option_frame, width=52)
+        self.ent_server_port.insert(0, str(self.local_server_port))
+        self.ent_server_port.pack(pady=(0,5))
+        
+        ttk.Label(option_frame, text="访问令牌:").pack(anchor='w', padx=5)
+        self.ent_server_token = ttk.Entry(option_frame, width=52)
+        self.ent_server_token.insert(0, self.local_server_token)
+        self.ent_server_token.config(state='readonly')
+        self.ent_server_token.pack(pady=(0,5))
+        
+        self.btn_server = ttk.Button(option_frame, text="应用", command=self.save_server_settings)
+        self.btn_server.pack(pady=5)
+        
+        usage_text = f"""Base URL: http://127.0.0.1:<端口>/v1
+请求头: Authorization: Bearer <访问令牌>
+接口: /v1/models、/v1/chat/completions（支持stream）
+模型 {COMPLETE_ALIAS} 使用补全Prompt，
+模型 {ASSISTANT_ALIAS} 使用助手Prompt，
+其余模型名原样转发给当前服务商。"""
+        help_frame = ttk.LabelFrame(server_frame, text="使用方法")
+        help_frame.pack(fill='x', padx=10, pady=5)
+        ttk.Label(help_frame, text=usage_text, justify='left').pack(anchor='w', padx=10, pady=5)
+        
+    def api_config(self):
+        """当前的服务商配置，供助手窗口和本地服务使用"""
+        return {
+            'api_key': self.apikey,
+            'api_url': self.base_url,
+            'model': self.model,
+            'temperature': self.temperature,
+            'custom_prompt': self.custom_prompt,
+            'compare_models': self.compare_models
+        }
+        
+    def apply_local_server(self):
+        """按配置启动、重启或停止本地服务"""
+        server = getattr(self, 'local_server', None)
+        if server and (not self.local_server_enabled or server.port != self.local_server_port):
+            server.stop()
+            self.local_server = server = None
+        if self.local_server_enabled and not server:
+            try:
+                self.local_server = LocalApiServer(self.api_config, port=self.local_server_port,
+                                                   token=self.local_server_token)
+                self.local_server.start()
+            except OSError as e:
+                self.local_server = None
+                print(f"本地服务启动失败: {str(e)}")
+                messagebox.showerror("错误", f"本地服务启动失败:\n{str(e)}")
+        
+    def save_server_settings(self):
+        """保存本地服务设置"""
+        try:
+            self.local_server_port = int(self.ent_server_port.get())
+        except ValueError:
+            messagebox.showwarning("警告", "请输入有效的端口")
+            return
+        self.local_server_enabled = self.local_server_var.get()
+        self.save_config()
+        self.apply_local_server()
+        self.btn_server["text"] = "已应用"
+        self.master.after(700, lambda: self.btn_server.configure(text="应用"))
+        
     def setup_tray(self):
         """设置系统托盘"""
         image = Image.open("linuxdo.ico")
         menu = (
             pystray.MenuItem('显示', self.show_window),
+            pystray.MenuItem('诊断', pystray.Menu(
+                pystray.MenuItem('设为基线', lambda icon: self.master.after(0, self.diagnostics_baseline)),
+                pystray.MenuItem('生成报告', lambda icon: self.master.after(0, self.diagnostics_report))
+            )),
             pystray.MenuItem('退出', self.quit_app)
         )
         self.icon = pystray.Icon("ChatFree", image, "ChatFree", menu)
         self.icon_thread = None
         
+    def diagnostics_baseline(self):
+        """记录诊断基线，之后的报告都与此对比"""
+        self.diagnostics.set_baseline()
+        messagebox.showinfo("诊断", "已记录基线，并开启内存追踪")
+        
+    def diagnostics_report(self):
+        """生成诊断报告，列出与基线相比增长的计数"""
+        path, changes = self.diagnostics.report()
+        grown = [f"{name}: {current} ({delta:+d})" for name, (current, _, delta) in changes.items() if delta > 0]
+        summary = "\n".join(grown) if grown else "与基线相比没有增长"
+        messagebox.showinfo("诊断", f"{summary}\n\n报告已写入: {os.path.abspath(path)}")
+        
     def show_window(self, icon=None):
         """显示窗口"""
         if self.icon_thread and self.icon_thread.is_alive():
@@ -441,6 +1111,11 @@ class ChatFreeApp:
             if self.keyboard_listener:
                 self.keyboard_listener.stop()
             
+            usage_tracker.flush()
+            
+            if self.local_server:
+                self.local_server.stop()
+            
             if self.icon_thread and self.icon_thread.is_alive():
                 self.icon.stop()
             
@@ -549,9 +1224,37 @@ class ChatFreeApp:
                     self.custom_prompt = config.get('custom_prompt', "你是一个专业的文本续写助手...")
                     self.hotkey = config.get('hotkey', 'ctrl+alt+\\')
                     self.assistant_hotkey = config.get('assistant_hotkey', 'alt+r')
+                    self.daily_budget = config.get('daily_budget', 0.0)
+                    self.compress_requests = config.get('compress_requests', False)
+                    self.local_server_enabled = config.get('local_server_enabled', False)
+                    self.local_server_port = config.get('local_server_port', DEFAULT_PORT)
+                    self.local_server_token = config.get('local_server_token', '')
+                    self.completion_context = config.get('completion_context', 'window')
+                    self.compare_models = config.get('compare_models', [])
+                    self.prewarm_budget = config.get('prewarm_budget', 30)
+                    self.completion_candidates = config.get('completion_candidates', 1)
+                    self.cycle_hotkey = config.get('cycle_hotkey', 'alt+n')
+                    self.model_prices = config.get('model_prices', {})
             else:
                 self.selected_api = 'OpenAI'
                 self.base_url = self.preset_apis['OpenAI']
+                self.daily_budget = 0.0
+                self.compress_requests = False
+                self.local_server_enabled = False
+                self.local_server_port = DEFAULT_PORT
+                self.local_server_token = ''
+                self.completion_context = 'window'
+                self.compare_models = []
+                self.prewarm_budget = 30
+                self.completion_candidates = 1
+                self.cycle_hotkey = 'alt+n'
+                self.model_prices = {}
+            if not self.local_server_token:
+                self.local_server_token = secrets.token_urlsafe(24)
+            usage_tracker.daily_cap = self.daily_budget
+            usage_tracker.set_price_overrides(self.model_prices)
+            set_request_compression(self.compress_requests)
+            set_prewarm_budget(self.prewarm_budget)
         except Exception as e:
             print(f"加载配置文件失败: {str(e)}")
 
@@ -567,7 +1270,18 @@ class ChatFreeApp:
             'keep_history': self.keep_history,
             'custom_prompt': self.custom_prompt,
             'hotkey': self.hotkey,
-            'assistant_hotkey': self.assistant_hotkey
+            'assistant_hotkey': self.assistant_hotkey,
+            'daily_budget': self.daily_budget,
+            'compress_requests': self.compress_requests,
+            'local_server_enabled': self.local_server_enabled,
+            'local_server_port': self.local_server_port,
+            'local_server_token': self.local_server_token,
+            'completion_context': self.completion_context,
+            'compare_models': self.compare_models,
+            'prewarm_budget': self.prewarm_budget,
+            'completion_candidates': self.completion_candidates,
+            'cycle_hotkey': self.cycle_hotkey,
+            'model_prices': self.model_prices
         }
         try:
             with open(self.config_file, 'w', encoding='utf-8') as f:
@@ -580,6 +1294,7 @@ class ChatFreeApp:
         """保存设置"""
         self.apikey = self.ent_apikey.get()
         selected_api = self.cmb_api_type.get()
+        old_base_url = self.base_url
         
         if selected_api == "自定义":
             self.base_url = self.ent_base_url.get()
@@ -589,6 +1304,13 @@ class ChatFreeApp:
         self.model = self.model_var.get()
         self.temperature = float(self.ent_temperature.get())
         self.keep_history = self.keep_history_var.get()
+        self.completion_context = next((k for k, v in COMPLETION_CONTEXT_NAMES.items()
+                                        if v == self.cmb_completion_context.get()), 'window')
+        # config.json中以字典填写的其他服务商模型不在输入框中显示，保存时原样保留
+        self.compare_models = ([m for m in self.compare_models if isinstance(m, dict)]
+                               + [m.strip() for m in self.ent_compare_models.get().split(',') if m.strip()])
+        self.compress_requests = self.compress_requests_var.get()
+        set_request_compression(self.compress_requests)
         self.custom_prompt = self.txt_prompt.get('1.0', 'end-1c')
         
         new_hotkey = self.ent_hotkey.get()
@@ -596,8 +1318,16 @@ class ChatFreeApp:
         
         self.hotkey = new_hotkey
         self.assistant_hotkey = new_assistant_hotkey
+        self.cycle_hotkey = self.ent_cycle_hotkey.get()
+        self.completion_candidates = int(self.cmb_candidates.get())
                 
         self.save_config()
+        self.completion_sessions.clear()
+        # 缓存的候选是按旧的模型、提示词和参数生成的，不能再注入
+        self.candidate_cache.clear()
+        self.last_injection = None
+        if self.base_url != old_base_url:
+            prewarm(self.base_url, "切换服务商")
         
         self.btn_submit["text"] = "保存成功"
         self.master.after(700, lambda: self.btn_submit.configure(text="保存设置"))
@@ -607,14 +1337,20 @@ class ChatFreeApp:
         def on_press(key):
             try:
                 # print(f"按下按键: {key}") 
+                if key not in self.current_keys and key in self.hotkey_modifiers():
+                    # 按下修饰键到按全快捷键之间通常有几百毫秒，足够提前建立连接
+                    prewarm(self.base_url, "快捷键")
                 self.current_keys.add(key)
                 
                 if self.check_hotkey(self.hotkey):
                     print("触发补全快捷键")
-                    self.complete()
+                    threading.Thread(target=self.complete, daemon=True).start()
                 if self.check_hotkey(self.assistant_hotkey):
                     print("触发助手快捷键")
                     self.show_dialog()
+                if self.check_hotkey(self.cycle_hotkey):
+                    print("触发切换候选快捷键")
+                    threading.Thread(target=self.cycle_candidate, daemon=True).start()
                     
             except Exception as e:
                 print(f"按键处理错误: {str(e)}")
@@ -631,6 +1367,14 @@ class ChatFreeApp:
             on_release=on_release)
         self.keyboard_listener.start()
 
+    def hotkey_modifiers(self):
+        """补全和助手快捷键用到的修饰键"""
+        modifiers = {'ctrl': (Key.ctrl_l, Key.ctrl_r),
+                     'alt': (Key.alt_l, Key.alt_r),
+                     'shift': (Key.shift_l, Key.shift_r)}
+        parts = set(self.hotkey.lower().split('+')) | set(self.assistant_hotkey.lower().split('+'))
+        return {key for mod, keys in modifiers.items() if mod in parts for key in keys}
+
     def check_hotkey(self, hotkey_str):
         """检查快捷键是否被按下"""
         try:
@@ -710,7 +1454,7 @@ class ChatFreeApp:
             except:
                 pass
 
-        keyboard = pynput_keyboard.Controller()
+        keyboard = self.keyboard_controller
         try:
             keyboard.release(Key.ctrl)
             keyboard.release(Key.shift)
@@ -764,13 +1508,68 @@ class ChatFreeApp:
 
         return selected_text
 
+    def new_completion_session(self, context_key):
+        """为一个补全上下文创建会话"""
+        print(f"新建补全会话: {context_key}")
+        return ChatSession(
+            api_key=self.apikey,
+            base_url=self.base_url,
+            model=self.model,
+            system_prompt={
+                "role": "system", 
+                "content": self.custom_prompt
+            },
+            max_history=COMPLETION_MAX_HISTORY
+        )
+    
+    def completion_context_key(self):
+        """当前补全的上下文key，获取失败时退回全局"""
+        key_func = COMPLETION_CONTEXT_KEYS.get(self.completion_context, COMPLETION_CONTEXT_KEYS['global'])
+        try:
+            return key_func()
+        except Exception as e:
+            print(f"获取补全上下文失败，使用全局上下文: {e}")
+            return "global"
+
+    def watch_ctrl(self, token):
+        """补全期间长按Ctrl立即取消请求"""
+        while not token.cancelled and self.completion_token is token:
+            if keyboard.is_pressed('ctrl'):
+                print("检测到Ctrl，终止补全")
+                token.cancel()
+                return
+            time.sleep(0.05)
+
     def complete(self):
-        """文本补全功能"""
+        """文本补全功能，新的补全会先取消进行中的补全"""
+        previous = self.completion_token
+        if previous:
+            previous.cancel()
+        with self.completion_lock:
+            token = CancelToken()
+            self.completion_token = token
+            try:
+                self.complete_with(token)
+            finally:
+                if self.completion_token is token:
+                    self.completion_token = None
+
+    def complete_with(self, token):
+        """执行一次补全，token被取消时立即中断请求和输入"""
         try:
+            self.last_injection = None
+            context_key = self.completion_context_key()
             selected_text = self.get_selected_text()
             if not selected_text:
                 print("未获取到选中文本")
                 return
+            if token.cancelled:
+                return
+
+            n = self.completion_candidates
+            cache_key = (context_key, selected_text)
+            if n > 1 and self.inject_cached(cache_key):
+                return
 
             print(f"开始补全文本: {selected_text}")
             
@@ -779,15 +1578,7 @@ class ChatFreeApp:
             msg = "【请稍等，等待补全】"
             keyboard.write(msg)
 
-            self.chat_session = ChatSession(
-                api_key=self.apikey,
-                base_url=self.base_url,
-                model=self.model,
-                system_prompt={
-                    "role": "system", 
-                    "content": self.custom_prompt
-                }                    
-            )
+            self.chat_session = self.completion_sessions.get(context_key)
 
             for _ in range(len(msg)):
                 keyboard.press_and_release('backspace')
@@ -801,30 +1592,125 @@ class ChatFreeApp:
             if not self.keep_history:
                 self.chat_session.clear_history()
             
-            response = self.chat_session.chat(selected_text, temperature=self.temperature)
+            threading.Thread(target=self.watch_ctrl, args=(token,), daemon=True).start()
+            outcome = {}
+            if n > 1:
+                stream = self.chat_session.chat_candidates(selected_text, n, temperature=self.temperature,
+                                                           cancel_token=token, outcome=outcome)
+            else:
+                stream = self.chat_session.chat_stream(selected_text, temperature=self.temperature,
+                                                       cancel_token=token)
+            typed = []
+            try:
+                for delta in stream:
+                    if is_error_response(delta):
+                        print(f"API错误: {delta}")
+                        keyboard.write(f" >> {delta}")
+                        return
+                    for char in delta:
+                        if token.cancelled:
+                            break
+                        keyboard.write(char)
+                        typed.append(char)
+                        time.sleep(0.01)
+                    if token.cancelled:
+                        break
+            finally:
+                stream.close()
 
-            if response.startswith(("\n发生错误", "request error", "API请求错误")):
-                print(f"API错误: {response}")
-                keyboard.write(f" >> {response}")
+            if token.cancelled:
+                keyboard.write(" >> 用户终止")
+                keyboard.release('ctrl')
                 return
 
-            for char in response:
-                if keyboard.is_pressed('ctrl'):
-                    keyboard.write(" >> 用户终止")
-                    keyboard.release('ctrl')
-                    return
-                keyboard.write(char)
-                time.sleep(0.01)
-
             keyboard.write("】")
 
             for _ in range(len(msg)):
                 keyboard.press_and_release('delete')
 
+            if n > 1:
+                self.remember_candidates(cache_key, "".join(typed), outcome.get('choices'))
+
         except Exception as e:
             print(f"补全过程发生错误: {str(e)}")
             return
 
+    def remember_candidates(self, cache_key, injected, choices):
+        """缓存本次选中文本的全部候选，记录刚注入的是哪一个，供切换候选使用"""
+        choices = choices or [injected]
+        if injected not in choices:
+            choices = [injected] + choices
+        self.candidate_cache[cache_key] = {"choices": choices, "next": 1}
+        self.candidate_cache.move_to_end(cache_key)
+        while len(self.candidate_cache) > CANDIDATE_CACHE_SIZE:
+            self.candidate_cache.popitem(last=False)
+        self.last_injection = {
+            "key": cache_key,
+            "index": choices.index(injected),
+            "text": injected,
+            "window": self.injection_window(),
+            "session": self.chat_session
+        }
+        print(f"已缓存{len(choices)}个候选，按 {self.cycle_hotkey} 切换")
+
+    def inject_cached(self, cache_key):
+        """同一段选中文本再次补全时，直接注入下一个还没用过的缓存候选，不发请求"""
+        entry = self.candidate_cache.get(cache_key)
+        if not entry or entry["next"] >= len(entry["choices"]):
+            return False
+        index = entry["next"]
+        entry["next"] += 1
+        self.candidate_cache.move_to_end(cache_key)
+        text = entry["choices"][index]
+        print(f"使用缓存的第{index + 1}个候选")
+        keyboard.press_and_release('right')
+        keyboard.write("【" + text + "】")
+        self.last_injection = {
+            "key": cache_key,
+            "index": index,
+            "text": text,
+            "window": self.injection_window(),
+            # 历史中的最后一条回复不是这个候选，切换时不改写历史
+            "session": None
+        }
+        return True
+
+    def injection_window(self):
+        """注入补全时的前台窗口，切换候选前用来确认光标仍在原窗口"""
+        try:
+            return foreground_window_key()
+        except Exception as e:
+            print(f"获取前台窗口失败: {e}")
+            return None
+
+    def cycle_candidate(self):
+        """把刚注入的补全换成下一个缓存的候选，无需等待网络"""
+        injection = self.last_injection
+        if not injection or self.completion_token is not None:
+            return
+        window = self.injection_window()
+        if window is None or window != injection["window"]:
+            print("窗口已切换，不再切换候选")
+            return
+        entry = self.candidate_cache.get(injection["key"])
+        if not entry or len(entry["choices"]) < 2:
+            print("没有可切换的候选")
+            return
+        with self.completion_lock:
+            index = (injection["index"] + 1) % len(entry["choices"])
+            text = entry["choices"][index]
+            for key in (Key.ctrl, Key.shift, Key.alt):
+                self.keyboard_controller.release(key)
+            # 光标在注入内容末尾的】之后
+            for _ in range(len(injection["text"]) + 1):
+                keyboard.press_and_release('backspace')
+            keyboard.write(text + "】")
+            injection.update(index=index, text=text)
+            entry["next"] = max(entry["next"], index + 1)
+            if self.keep_history and injection["session"]:
+                injection["session"].replace_last_reply(text)
+            print(f"已切换到第{index + 1}/{len(entry['choices'])}个候选")
+
     def show_dialog(self):
         """显示对话窗口"""
         try:         
@@ -836,12 +1722,7 @@ class ChatFreeApp:
                 print(f"获取选中文本时错: {e}")
                 pass
             
-            config = {
-                'api_key': self.apikey,
-                'api_url': self.base_url,
-                'model': self.model,
-                'temperature': self.temperature
-            }
+            config = self.api_config()
             
             if self.master.winfo_exists():
                 dialog = DialogWindow(self.master, selected_text, config)
@@ -8,6 +8,10 @@ a = Analysis(
         ('config.json', '.'),
         ('linuxdo.ico', '.'),
         ('ai_api.py', '.'),
+        ('usage_stats.py', '.'),
+        ('local_server.py', '.'),
+        ('transport.py', '.'),
+        ('diagnostics.py', '.'),
     ],
     hiddenimports=[
         'tkinter',
@@ -15,10 +19,15 @@ a = Analysis(
         'tkinter.constants',
         'keyboard',
         'win32clipboard',
+        'win32api',
+        'win32gui',
+        'win32process',
         'requests',
         'winreg',
         'urllib3',
         'certifi',
+        'sqlite3',
+        'http.server',
         'idna',
         'charset_normalizer',
         'pywin32',
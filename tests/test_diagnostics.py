@@ -0,0 +1,54 @@
+"""
+诊断计数与基线对比，不需要界面
+"""
+
+import os
+import sys
+import threading
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from diagnostics import Diagnostics, count_instances
+
+
+class Leaky:
+    pass
+
+
+def test_diff_reports_leaked_objects_and_threads(tmp_path):
+    diagnostics = Diagnostics(report_dir=str(tmp_path))
+    diagnostics.add_probe("Leaky", lambda: count_instances(Leaky))
+    diagnostics.set_baseline()
+
+    leaked = [Leaky() for _ in range(3)]
+    stop = threading.Event()
+    threads = [threading.Thread(target=stop.wait, name=f"leak-worker-{i}", daemon=True) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    try:
+        changes = diagnostics.diff()
+        assert changes["Leaky"] == (3, 0, 3)
+        assert changes["线程"][2] == 2
+        assert changes["线程: leak-worker"] == (2, 0, 2)
+
+        path, reported = diagnostics.report()
+        assert reported["Leaky"][2] == 3
+        with open(path, encoding='utf-8') as f:
+            assert "Leaky: 3 / 0 / +3" in f.read()
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        del leaked
+
+    try:
+        assert diagnostics.diff()["Leaky"][2] == 0
+    finally:
+        tracemalloc.stop()
+
+
+def test_failing_probe_is_reported_not_raised(tmp_path):
+    diagnostics = Diagnostics(report_dir=str(tmp_path))
+    diagnostics.add_probe("坏的计数", lambda: 1 / 0)
+    assert diagnostics.counts()["坏的计数"] == -1
@@ -0,0 +1,55 @@
+"""
+用tests/cassettes中的回放记录离线测试ChatSession，不需要密钥和网络
+"""
+
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ai_api
+from ai_api import ChatSession
+from transport import Cassette, ReplayTransport
+from usage_stats import UsageTracker
+
+CASSETTES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cassettes")
+SYSTEM_PROMPT = {"role": "system", "content": "你是一个写作助手"}
+
+
+@pytest.fixture
+def session(tmp_path, monkeypatch):
+    monkeypatch.setattr(ai_api, "usage_tracker", UsageTracker(db_path=str(tmp_path / "usage.db")))
+    transport = ReplayTransport(Cassette(CASSETTES), time_scale=0)
+    return ChatSession("sk-test", "https://api.openai.com/v1", "gpt-4o-mini", SYSTEM_PROMPT,
+                       transport=transport)
+
+
+def test_chat_stream_replays_deltas(session):
+    assert list(session.chat_stream("你好")) == ["Hel", "lo ", "wor", "ld"]
+    assert session.message_history[-1] == {"role": "assistant", "content": "Hello world"}
+    assert session.last_usage["prompt_tokens"] == 10
+    assert session.last_usage["completion_tokens"] == 4
+
+
+def test_chat_replays_reply(session):
+    assert session.chat("补全这句话") == "补全这句话，让它读起来更通顺。"
+    assert session.last_usage["completion_tokens"] == 3
+
+
+def test_replay_keeps_recorded_timing(tmp_path, monkeypatch):
+    monkeypatch.setattr(ai_api, "usage_tracker", UsageTracker(db_path=str(tmp_path / "usage.db")))
+    session = ChatSession("sk-test", "https://api.openai.com/v1", "gpt-4o-mini", SYSTEM_PROMPT,
+                          transport=ReplayTransport(Cassette(CASSETTES), time_scale=1))
+    started = time.monotonic()
+    arrivals = [time.monotonic() - started for _ in session.chat_stream("你好")]
+    # 记录中最后一段约在0.15秒后到达
+    assert arrivals[-1] >= 0.12
+
+
+def test_unrecorded_request_is_an_error(session):
+    reply = session.chat("记录中没有的问题")
+    assert ai_api.is_error_response(reply)
+    assert session.message_history == []
@@ -0,0 +1,188 @@
+"""
+相同请求合并（SingleFlight）的并发行为：用可控的传输层离线测试
+"""
+
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ai_api
+from ai_api import CancelToken, ChatSession
+from usage_stats import UsageTracker
+
+SYSTEM_PROMPT = {"role": "system", "content": "你是一个写作助手"}
+TIMEOUT = 5
+
+
+class FakeResponse:
+    """由测试逐行推送内容的响应，记录是否被关闭"""
+
+    status_code = 200
+    headers = {}
+
+    def __init__(self, body=None):
+        self.body = body
+        self.lines = queue.Queue()
+        self.closed = threading.Event()
+
+    @property
+    def text(self):
+        return self.body
+
+    def json(self):
+        return json.loads(self.body)
+
+    def push(self, *deltas):
+        for delta in deltas:
+            chunk = {"choices": [{"index": 0, "delta": {"content": delta}}]}
+            self.lines.put(b"data: " + json.dumps(chunk).encode('utf-8'))
+
+    def end(self):
+        self.lines.put(b"data: [DONE]")
+        self.lines.put(None)
+
+    def iter_lines(self):
+        while not self.closed.is_set():
+            line = self.lines.get()
+            if line is None:
+                return
+            yield line
+
+    def close(self):
+        self.closed.set()
+        self.lines.put(None)
+
+
+class FakeTransport:
+    """统计上游请求次数；gate打开前请求一直阻塞，便于让所有调用方先加入"""
+
+    def __init__(self, response):
+        self.response = response
+        self.posts = 0
+        self.gate = threading.Event()
+
+    def post(self, url, headers=None, data=None, timeout=30, stream=False):
+        self.posts += 1
+        self.gate.wait(TIMEOUT)
+        return self.response
+
+
+def wait_until(predicate):
+    deadline = time.monotonic() + TIMEOUT
+    while not predicate():
+        assert time.monotonic() < deadline, "等待超时"
+        time.sleep(0.005)
+
+
+def current_flight():
+    flights = list(ai_api._inflight._flights.values())
+    return flights[0] if flights else None
+
+
+def waiters(count):
+    return lambda: current_flight() is not None and current_flight().waiters == count
+
+
+@pytest.fixture(autouse=True)
+def tracker(tmp_path, monkeypatch):
+    monkeypatch.setattr(ai_api, "usage_tracker", UsageTracker(db_path=str(tmp_path / "usage.db")))
+
+
+def new_session(transport):
+    return ChatSession("sk-test", "https://api.example.com/v1", "test-model", SYSTEM_PROMPT,
+                       transport=transport)
+
+
+def consume(generator, into):
+    thread = threading.Thread(target=lambda: into.extend(generator), daemon=True)
+    thread.start()
+    return thread
+
+
+def test_concurrent_identical_chats_post_once():
+    body = {"choices": [{"index": 0, "message": {"content": "共享的回复"}}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 3}}
+    transport = FakeTransport(FakeResponse(json.dumps(body, ensure_ascii=False)))
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(new_session(transport).chat("合并我")))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    wait_until(waiters(5))
+    transport.gate.set()
+    for thread in threads:
+        thread.join(TIMEOUT)
+
+    assert transport.posts == 1
+    assert results == ["共享的回复"] * 5
+
+
+def test_late_stream_joiner_gets_every_delta():
+    response = FakeResponse()
+    transport = FakeTransport(response)
+    transport.gate.set()
+    first, late = [], []
+    first_thread = consume(new_session(transport).chat_stream("晚到的人"), first)
+    response.push("一", "二")
+    wait_until(lambda: len(first) == 2)
+
+    late_thread = consume(new_session(transport).chat_stream("晚到的人"), late)
+    wait_until(waiters(2))
+    response.push("三")
+    response.end()
+    first_thread.join(TIMEOUT)
+    late_thread.join(TIMEOUT)
+
+    assert transport.posts == 1
+    assert first == late == ["一", "二", "三"]
+
+
+def test_cancelling_one_waiter_keeps_the_other_stream():
+    response = FakeResponse()
+    transport = FakeTransport(response)
+    transport.gate.set()
+    token = CancelToken()
+    cancelled, kept = [], []
+    cancelled_thread = consume(new_session(transport).chat_stream("取消一个", cancel_token=token), cancelled)
+    kept_thread = consume(new_session(transport).chat_stream("取消一个"), kept)
+    wait_until(waiters(2))
+    response.push("一")
+    wait_until(lambda: cancelled == kept == ["一"])
+
+    token.cancel()
+    cancelled_thread.join(TIMEOUT)
+    wait_until(waiters(1))
+    assert not response.closed.is_set()
+
+    response.push("二", "三")
+    response.end()
+    kept_thread.join(TIMEOUT)
+
+    assert cancelled == ["一"]
+    assert kept == ["一", "二", "三"]
+
+
+def test_last_waiter_leaving_closes_upstream():
+    response = FakeResponse()
+    transport = FakeTransport(response)
+    transport.gate.set()
+    token = CancelToken()
+    received = []
+    thread = consume(new_session(transport).chat_stream("都走了", cancel_token=token), received)
+    response.push("一")
+    wait_until(lambda: received == ["一"])
+
+    flight = current_flight()
+    token.cancel()
+    thread.join(TIMEOUT)
+
+    assert response.closed.wait(TIMEOUT)
+    assert flight.cancelled
+    assert current_flight() is None
@@ -0,0 +1,426 @@
+"""
+传输层：ChatSession与HTTP之间的接口，支持三种模式
+live   直接请求服务商（默认）
+record 请求服务商并把请求和响应（请求头脱敏、保留SSE每行的到达时间）保存为回放记录
+replay 不联网，按原始或缩放后的时间回放记录，用于离线测试和性能分析
+
+通过环境变量选择：CHATFREE_TRANSPORT=record/replay，CHATFREE_CASSETTES=记录目录，
+CHATFREE_REPLAY_SCALE=回放时间倍率（1为原速，0为不等待）
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import urlencode, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import winreg
+except ImportError:
+    winreg = None
+
+DEFAULT_CASSETTE_DIR = "cassettes"
+REDACTED = "<redacted>"
+SENSITIVE_HEADERS = ("authorization", "api-key", "x-api-key", "cookie", "set-cookie")
+SENSITIVE_PARAMS = ("key", "api_key")
+
+
+def get_proxy():
+    """读取Windows系统代理设置，其他系统不使用代理"""
+    if winreg is None:
+        return {"http": None, "https": None}
+    try:
+        with winreg.OpenKey(winreg.HKEY_CURRENT_USER, r"Software\Microsoft\Windows\CurrentVersion\Internet Settings") as key:
+            proxy_enable, _ = winreg.QueryValueEx(key, "ProxyEnable")
+            proxy_server, _ = winreg.QueryValueEx(key, "ProxyServer")
+
+            if proxy_enable and proxy_server:
+                proxy_parts = proxy_server.split(":")
+                if len(proxy_parts) == 2:
+                    return {"http": f"http://{proxy_server}", "https": f"http://{proxy_server}"}
+    except OSError:
+        pass
+    return {"http": None, "https": None}
+
+
+def redact_headers(headers):
+    return {k: (REDACTED if k.lower() in SENSITIVE_HEADERS else v) for k, v in (headers or {}).items()}
+
+
+def request_key(method, url, params=None, body=None):
+    """
+    回放时用来匹配请求的key：方法、地址、除密钥外的参数和解压后的请求体
+    密钥不参与计算，换了密钥的记录也能回放
+    """
+    if params:
+        query = urlencode(sorted((k, v) for k, v in params.items() if k not in SENSITIVE_PARAMS))
+        url = f"{url}?{query}" if query else url
+    digest = hashlib.sha256(f"{method} {url}\n".encode('utf-8'))
+    if body:
+        if body[:2] == b"\x1f\x8b":
+            body = gzip.decompress(body)
+        digest.update(body)
+    return digest.hexdigest()
+
+
+class LiveTransport:
+    """直接请求服务商，共享连接池，并发分段请求时复用TCP/TLS连接"""
+
+    mode = "live"
+
+    def __init__(self, pool_maxsize=8):
+        self.http = requests.Session()
+        self.http.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize))
+        self.http.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize))
+
+    def post(self, url, headers=None, data=None, timeout=30, stream=False):
+        return self.http.post(url, headers=headers, data=data, proxies=get_proxy(),
+                              verify=True, timeout=timeout, stream=stream)
+
+    def get(self, url, headers=None, params=None, timeout=10):
+        return self.http.get(url, headers=headers, params=params, proxies=get_proxy(),
+                             verify=True, timeout=timeout)
+
+    def warm(self, url, timeout=5):
+        """发一个HEAD请求，只为建立连接并留在连接池中，响应状态不重要"""
+        return self.http.head(url, proxies=get_proxy(), verify=True, timeout=timeout, allow_redirects=False)
+
+
+class Cassette:
+    """
+    一个目录下的回放记录，每个请求key对应一个JSON文件
+    同一请求被记录多次时按顺序保存，回放时依次取出，取完后重复最后一条
+    """
+
+    def __init__(self, path=DEFAULT_CASSETTE_DIR):
+        self.path = path
+        self._lock = threading.Lock()
+        self._cursor = {}
+
+    def _file(self, key):
+        return os.path.join(self.path, f"{key[:24]}.json")
+
+    def _load(self, key):
+        try:
+            with open(self._file(key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    def append(self, key, exchange):
+        with self._lock:
+            os.makedirs(self.path, exist_ok=True)
+            exchanges = self._load(key)
+            exchanges.append(exchange)
+            with open(self._file(key), 'w', encoding='utf-8') as f:
+                json.dump(exchanges, f, ensure_ascii=False, indent=1)
+
+    def next(self, key):
+        with self._lock:
+            exchanges = self._load(key)
+            if not exchanges:
+                return None
+            index = self._cursor.get(key, 0)
+            self._cursor[key] = index + 1
+            return exchanges[min(index, len(exchanges) - 1)]
+
+
+class _RecordingResponse:
+    """包装真实响应，读取的同时记下内容和每行SSE的到达时间，读完后写入回放记录"""
+
+    def __init__(self, response, started, save):
+        self._response = response
+        self._started = started
+        self._save = save
+        self._events = None
+        self._body = None
+        self._complete = False
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.elapsed = time.monotonic() - started
+
+    @property
+    def text(self):
+        if self._body is None:
+            self._body = self._response.text
+            self._complete = True
+        return self._body
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_lines(self):
+        self._events = []
+        for line in self._response.iter_lines():
+            self._events.append([round(time.monotonic() - self._started, 4), line.decode('utf-8')])
+            if line.strip() == b"data: [DONE]":
+                # 调用方读到结束标记就会关闭响应，不会再迭代到流的末尾
+                self._complete = True
+            yield line
+        self._complete = True
+
+    def close(self):
+        self._response.close()
+        if self._save is not None:
+            save, self._save = self._save, None
+            if self._complete:
+                save({
+                    "status": self.status_code,
+                    "headers": redact_headers(dict(self.headers)),
+                    "elapsed": round(self.elapsed, 4),
+                    "body": self._body,
+                    "events": self._events
+                })
+            else:
+                print("未读完的响应不写入回放记录")
+
+
+class RecordingTransport(LiveTransport):
+    """请求服务商并把每次交互写入回放记录"""
+
+    mode = "record"
+
+    def __init__(self, cassette, pool_maxsize=8):
+        super().__init__(pool_maxsize)
+        self.cassette = cassette
+
+    def _exchange(self, method, url, headers, params, body):
+        request = {
+            "method": method,
+            "url": url,
+            "headers": redact_headers(headers),
+            "params": {k: (REDACTED if k in SENSITIVE_PARAMS else v) for k, v in (params or {}).items()},
+            "body": (gzip.decompress(body) if body[:2] == b"\x1f\x8b" else body).decode('utf-8') if body else None
+        }
+        key = request_key(method, url, params, body)
+        return lambda response: self.cassette.append(key, {"request": request, "response": response})
+
+    def post(self, url, headers=None, data=None, timeout=30, stream=False):
+        started = time.monotonic()
+        response = super().post(url, headers, data, timeout, stream)
+        return _RecordingResponse(response, started, self._exchange("POST", url, headers, None, data))
+
+    def get(self, url, headers=None, params=None, timeout=10):
+        started = time.monotonic()
+        response = super().get(url, headers, params, timeout)
+        recorded = _RecordingResponse(response, started, self._exchange("GET", url, headers, params, None))
+        try:
+            recorded.json()
+        except ValueError:
+            pass
+        recorded.close()
+        return recorded
+
+
+class _ReplayResponse:
+    """回放的响应，接口与requests.Response中ChatSession用到的部分一致"""
+
+    def __init__(self, recorded, scale):
+        self.status_code = recorded["status"]
+        self.headers = recorded.get("headers") or {}
+        self._recorded = recorded
+        self._scale = scale
+        self._started = time.monotonic()
+        self._closed = False
+
+    def _wait_until(self, offset):
+        delay = offset * self._scale - (time.monotonic() - self._started)
+        if delay > 0:
+            time.sleep(delay)
+
+    @property
+    def text(self):
+        if self._recorded.get("body") is not None:
+            return self._recorded["body"]
+        return "\n".join(line for _, line in self._recorded.get("events") or [])
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_lines(self):
+        events = self._recorded.get("events")
+        if events is None:
+            events = [[self._recorded.get("elapsed", 0), line] for line in self.text.split("\n")]
+        for offset, line in events:
+            if self._closed:
+                return
+            self._wait_until(offset)
+            yield line.encode('utf-8')
+
+    def close(self):
+        self._closed = True
+
+
+class ReplayTransport:
+    """不联网，从回放记录返回响应；time_scale为1按原始时间回放，0为不等待"""
+
+    mode = "replay"
+
+    def __init__(self, cassette, time_scale=1.0):
+        self.cassette = cassette
+        self.time_scale = time_scale
+
+    def _replay(self, method, url, params=None, body=None):
+        key = request_key(method, url, params, body)
+        exchange = self.cassette.next(key)
+        if exchange is None:
+            raise LookupError(f"回放记录中没有该请求: {method} {urlparse(url).path} ({key[:24]})")
+        response = _ReplayResponse(exchange["response"], self.time_scale)
+        # 首字节时间
+        response._wait_until(exchange["response"].get("elapsed", 0))
+        return response
+
+    def post(self, url, headers=None, data=None, timeout=30, stream=False):
+        return self._replay("POST", url, body=data)
+
+    def get(self, url, headers=None, params=None, timeout=10):
+        return self._replay("GET", url, params=params)
+
+    def warm(self, url, timeout=5):
+        return None
+
+
+def transport_from_env(pool_maxsize=8):
+    """按环境变量创建传输层，未设置时为live"""
+    mode = os.environ.get("CHATFREE_TRANSPORT", "live").lower()
+    path = os.environ.get("CHATFREE_CASSETTES", DEFAULT_CASSETTE_DIR)
+    if mode == "record":
+        print(f"传输层: 录制模式，记录保存到 {path}")
+        return RecordingTransport(Cassette(path), pool_maxsize)
+    if mode == "replay":
+        scale = float(os.environ.get("CHATFREE_REPLAY_SCALE", "1"))
+        print(f"传输层: 回放模式，读取 {path}，时间倍率 {scale}")
+        return ReplayTransport(Cassette(path), scale)
+    return LiveTransport(pool_maxsize)
+
+
+class ConnectionWarmer:
+    """
+    连接预热：在真正发请求前建立到服务商的TCP/TLS连接并放入连接池
+    最近有请求的服务商会在后台定期重新预热，避免空闲连接被服务端关闭；
+    每小时的预热次数受预算限制
+    """
+
+    # 两次预热的最小间隔，以及服务端通常保留空闲连接的时长
+    MIN_INTERVAL = 20
+    KEEP_ALIVE = 60
+    ACTIVE_WINDOW = 600
+
+    def __init__(self, get_transport, budget_per_hour=30):
+        """
+        :param get_transport: 返回当前传输层的函数，预热和真正的请求需共用同一个连接池
+        :param budget_per_hour: 每小时最多预热次数，0为关闭预热
+        """
+        self.get_transport = get_transport
+        self.budget_per_hour = budget_per_hour
+        self.stats = {"warmups": 0, "hits": 0, "saved_seconds": 0.0}
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self._spent = []
+        self._keeper = None
+
+    def _host(self, url):
+        parsed = urlparse(url)
+        return parsed.netloc or url
+
+    def _take_budget(self):
+        now = time.monotonic()
+        self._spent = [t for t in self._spent if now - t < 3600]
+        if len(self._spent) >= self.budget_per_hour:
+            return False
+        self._spent.append(now)
+        return True
+
+    def warm_async(self, url, reason=""):
+        """在后台预热url所在的服务商，最近刚预热过或超出预算时跳过"""
+        if self.budget_per_hour <= 0 or not url:
+            return
+        host = self._host(url)
+        now = time.monotonic()
+        with self._lock:
+            state = self._hosts.setdefault(host, {"url": url, "warmed": None, "used": None,
+                                                  "pending": False, "connect_cost": None})
+            state["url"] = url
+            if state["pending"] or (state["warmed"] and now - state["warmed"] < self.MIN_INTERVAL):
+                return
+            if not self._take_budget():
+                print(f"连接预热: 已达到每小时{self.budget_per_hour}次的预算，跳过")
+                return
+            state["pending"] = True
+        threading.Thread(target=self._warm, args=(host, url, reason), daemon=True).start()
+        self._start_keeper()
+
+    def _head(self, url):
+        started = time.monotonic()
+        response = self.get_transport().warm(url)
+        if response is not None:
+            response.close()
+        return time.monotonic() - started
+
+    def _warm(self, host, url, reason):
+        try:
+            elapsed = self._head(url)
+            with self._lock:
+                state = self._hosts[host]
+                measure = state["connect_cost"] is None
+            if measure:
+                # 第二次请求复用刚建立的连接，两者之差即为建连（DNS、TCP、TLS、代理）的耗时
+                connect_cost = max(elapsed - self._head(url), 0.0)
+            with self._lock:
+                if measure:
+                    state["connect_cost"] = connect_cost
+                state["warmed"] = time.monotonic()
+                self.stats["warmups"] += 1
+            print(f"连接预热{f'（{reason}）' if reason else ''}: {host} {elapsed * 1000:.0f}ms，"
+                  f"建连约{state['connect_cost'] * 1000:.0f}ms")
+        except Exception as e:
+            print(f"连接预热失败: {host} {str(e)}")
+        finally:
+            with self._lock:
+                self._hosts[host]["pending"] = False
+
+    def note_request(self, url):
+        """
+        真正的请求发出前调用：记录活跃时间；若没有预热这个请求本需要重新建连，
+        把测得的建连耗时计入节省的首请求延迟
+        """
+        host = self._host(url)
+        now = time.monotonic()
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None:
+                self._hosts[host] = {"url": url, "warmed": None, "used": now,
+                                     "pending": False, "connect_cost": None}
+                return
+            warmed = state["warmed"]
+            # 上一个请求留下的连接已过期，而预热的连接仍在保活期内，才算预热省下了建连
+            if (warmed and state["connect_cost"] and now - warmed < self.KEEP_ALIVE
+                    and (state["used"] is None or now - state["used"] >= self.KEEP_ALIVE)):
+                self.stats["hits"] += 1
+                self.stats["saved_seconds"] += state["connect_cost"]
+            state["used"] = now
+
+    def _start_keeper(self):
+        with self._lock:
+            if self._keeper and self._keeper.is_alive():
+                return
+            self._keeper = threading.Thread(target=self._keep_warm, daemon=True)
+            self._keeper.start()
+
+    def _keep_warm(self):
+        """活跃期内在连接过期前重新预热；所有服务商都空闲后退出，下次预热时再启动"""
+        while True:
+            time.sleep(self.KEEP_ALIVE * 0.75)
+            now = time.monotonic()
+            with self._lock:
+                active = [(host, state["url"]) for host, state in self._hosts.items()
+                          if state["used"] and now - state["used"] < self.ACTIVE_WINDOW]
+            if not active:
+                return
+            for host, url in active:
+                self.warm_async(url, "保活")
@@ -0,0 +1,297 @@
+"""
+用量统计：记录每次请求的token、耗时和状态，内存中按模型汇总，定期批量写入本地SQLite
+"""
+
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from datetime import date
+from urllib.parse import urlparse
+
+USAGE_DB = "usage.db"
+FLUSH_INTERVAL = 30
+LATENCY_SAMPLES = 1000
+
+# 每百万token价格（美元）：输入、缓存命中的输入、输出；按模型名前缀匹配，最长者优先
+# 表中没有的模型可在config.json的model_prices中补充或覆盖
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.075, 0.6),
+    "gpt-4o": (2.5, 1.25, 10.0),
+    "gpt-4.1-mini": (0.4, 0.1, 1.6),
+    "gpt-4.1": (2.0, 0.5, 8.0),
+    "o3-mini": (1.1, 0.55, 4.4),
+    "deepseek-chat": (0.27, 0.07, 1.1),
+    "deepseek-reasoner": (0.55, 0.14, 2.19),
+    "gemini-1.5-flash": (0.075, 0.01875, 0.3),
+    "gemini-2.0-flash": (0.1, 0.025, 0.4),
+    "grok-2": (2.0, 2.0, 10.0),
+    "qwen-turbo": (0.05, 0.02, 0.2),
+    "qwen-plus": (0.4, 0.16, 1.2),
+    "GLM-4-Flash": (0.0, 0.0, 0.0),
+}
+
+
+def provider_of(url):
+    """用接口地址的域名作为服务商标识"""
+    return urlparse(url).netloc or url
+
+
+def percentile(values, pct):
+    """计算百分位数（最近邻法）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = math.ceil(pct / 100 * len(ordered))
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+class UsageTracker:
+    """请求用量记录器，record 只更新内存，写盘由后台线程定期完成"""
+
+    def __init__(self, db_path=USAGE_DB, flush_interval=FLUSH_INTERVAL):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.prices = dict(MODEL_PRICES)
+        self.daily_cap = 0.0
+        self._lock = threading.Lock()
+        self._pending = []
+        self._totals = {}
+        self._sessions = {}
+        self._latencies = {}
+        self._today = date.today().isoformat()
+        self._today_cost = 0.0
+        self._unpriced_today = set()
+        self._loaded = False
+        self._flusher = None
+
+    def set_price_overrides(self, overrides):
+        """
+        用配置中的价格补充或覆盖内置价格表
+        :param overrides: {模型名前缀: [输入, 缓存命中的输入, 输出]}，每百万token美元
+        """
+        prices = dict(MODEL_PRICES)
+        for name, price in (overrides or {}).items():
+            try:
+                prompt_price, cached_price, completion_price = (float(p) for p in price)
+            except (TypeError, ValueError):
+                print(f"模型价格格式错误，已忽略: {name}")
+                continue
+            prices[name] = (prompt_price, cached_price, completion_price)
+        self.prices = prices
+
+    def price_of(self, model):
+        """按最长前缀匹配模型价格，未知模型返回None"""
+        match = None
+        for name in self.prices:
+            if model and model.lower().startswith(name.lower()) and (match is None or len(name) > len(match)):
+                match = name
+        return self.prices.get(match)
+
+    def is_priced(self, model):
+        return self.price_of(model) is not None
+
+    def cost_of(self, model, usage):
+        """本次请求的花费，未定价的模型按0计"""
+        price = self.price_of(model)
+        if not usage or price is None:
+            return 0.0
+        prompt_price, cached_price, completion_price = price
+        cached = usage.get("cached_tokens", 0)
+        uncached = max(usage.get("prompt_tokens", 0) - cached, 0)
+        return (uncached * prompt_price
+                + cached * cached_price
+                + usage.get("completion_tokens", 0) * completion_price) / 1_000_000
+
+    def over_budget(self):
+        """是否已达到每日花费上限，请求前调用，只做内存比较"""
+        if self.daily_cap <= 0:
+            return False
+        if not self._loaded or self._today != date.today().isoformat():
+            with self._lock:
+                self._ensure_loaded()
+                self._roll_day()
+        return self._today_cost >= self.daily_cap
+
+    def unpriced_today(self):
+        """今天用过但没有价格的模型，这些请求的花费不计入每日上限"""
+        with self._lock:
+            self._ensure_loaded()
+            self._roll_day()
+            return sorted(self._unpriced_today)
+
+    def record(self, provider, model, usage, latency, status, session_id=None, tokens_saved=0):
+        """
+        记录一次上游请求
+        :param provider: 服务商标识
+        :param model: 模型名称
+        :param usage: parse_usage 解析后的用量，可为 None
+        :param latency: 请求耗时（秒）
+        :param status: ok / error / cancelled
+        :param session_id: 发起请求的会话标识
+        :param tokens_saved: 请求被取消时估算节省的输出token数
+        """
+        usage = usage or {}
+        cost = self.cost_of(model, usage)
+        unpriced = bool(usage) and not self.is_priced(model)
+        row = (
+            time.time(), date.today().isoformat(), session_id or "", provider, model or "",
+            usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0),
+            usage.get("cached_tokens", 0), round(latency, 3), status, cost, tokens_saved
+        )
+        with self._lock:
+            self._ensure_loaded()
+            self._roll_day()
+            self._pending.append(row)
+            self._add(self._totals, (provider, model or ""), row)
+            if session_id:
+                self._add(self._sessions, session_id, row)
+            self._latencies.setdefault((provider, model or ""), deque(maxlen=LATENCY_SAMPLES)).append(row[8])
+            self._today_cost += cost
+            warn = unpriced and (model or "") not in self._unpriced_today
+            if unpriced:
+                self._unpriced_today.add(model or "")
+        if warn:
+            print(f"模型 {model} 没有价格，花费按0计且不计入每日上限，可在config.json的model_prices中填写")
+        self._start_flusher()
+
+    @staticmethod
+    def _add(table, key, row):
+        total = table.setdefault(key, {
+            "requests": 0, "errors": 0, "prompt_tokens": 0,
+            "completion_tokens": 0, "cached_tokens": 0, "cost": 0.0, "tokens_saved": 0,
+            "ok_completion_tokens": 0
+        })
+        total["requests"] += 1
+        if row[9] != "ok":
+            total["errors"] += 1
+        else:
+            total["ok_completion_tokens"] += row[6]
+        total["prompt_tokens"] += row[5]
+        total["completion_tokens"] += row[6]
+        total["cached_tokens"] += row[7]
+        total["cost"] += row[10]
+        total["tokens_saved"] += row[11]
+
+    def _roll_day(self):
+        today = date.today().isoformat()
+        if today != self._today:
+            self._today = today
+            self._today_cost = 0.0
+            self._unpriced_today.clear()
+
+    def summary(self):
+        """按服务商和模型汇总，含p50/p95耗时，供设置页显示"""
+        with self._lock:
+            self._ensure_loaded()
+            rows = []
+            for (provider, model), total in sorted(self._totals.items()):
+                latencies = list(self._latencies.get((provider, model), ()))
+                rows.append(dict(total, provider=provider, model=model, priced=self.is_priced(model),
+                                 p50=percentile(latencies, 50), p95=percentile(latencies, 95)))
+            return rows
+
+    def expected_completion_tokens(self, provider, model):
+        """该模型成功请求的平均输出token数，没有记录时返回None"""
+        with self._lock:
+            total = self._totals.get((provider, model or ""))
+            if not total or total["requests"] <= total["errors"]:
+                return None
+            return total["ok_completion_tokens"] // (total["requests"] - total["errors"])
+
+    def session_totals(self, session_id):
+        with self._lock:
+            return dict(self._sessions.get(session_id, {}))
+
+    def today_cost(self):
+        with self._lock:
+            self._roll_day()
+            return self._today_cost
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("""CREATE TABLE IF NOT EXISTS usage (
+            ts REAL, day TEXT, session TEXT, provider TEXT, model TEXT,
+            prompt INTEGER, completion INTEGER, cached INTEGER,
+            latency REAL, status TEXT, cost REAL)""")
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(usage)")]
+        if "saved" not in columns:
+            conn.execute("ALTER TABLE usage ADD COLUMN saved INTEGER DEFAULT 0")
+        return conn
+
+    def _ensure_loaded(self):
+        """首次使用时从本地记录恢复汇总、近期耗时和当日花费"""
+        if self._loaded:
+            return
+        self._loaded = True
+        if not os.path.exists(self.db_path):
+            return
+        try:
+            conn = self._connect()
+            try:
+                for (provider, model, requests, errors, prompt, completion, cached, cost, saved,
+                     ok_completion) in conn.execute(
+                        "SELECT provider, model, COUNT(*), SUM(status != 'ok'), SUM(prompt), "
+                        "SUM(completion), SUM(cached), SUM(cost), SUM(saved), "
+                        "SUM(CASE WHEN status = 'ok' THEN completion ELSE 0 END) "
+                        "FROM usage GROUP BY provider, model"):
+                    self._totals[(provider, model)] = {
+                        "requests": requests, "errors": errors or 0, "prompt_tokens": prompt or 0,
+                        "completion_tokens": completion or 0, "cached_tokens": cached or 0,
+                        "cost": cost or 0.0, "tokens_saved": saved or 0,
+                        "ok_completion_tokens": ok_completion or 0
+                    }
+                for provider, model, latency in conn.execute(
+                        "SELECT provider, model, latency FROM usage ORDER BY ts DESC LIMIT ?",
+                        (LATENCY_SAMPLES * 4,)):
+                    samples = self._latencies.setdefault((provider, model), deque(maxlen=LATENCY_SAMPLES))
+                    if len(samples) < LATENCY_SAMPLES:
+                        samples.appendleft(latency)
+                row = conn.execute("SELECT SUM(cost) FROM usage WHERE day = ?", (self._today,)).fetchone()
+                self._today_cost = row[0] or 0.0
+                for (model,) in conn.execute(
+                        "SELECT DISTINCT model FROM usage WHERE day = ? AND prompt + completion > 0",
+                        (self._today,)):
+                    if not self.is_priced(model):
+                        self._unpriced_today.add(model)
+            finally:
+                conn.close()
+        except Exception as e:
+            print(f"读取用量记录失败: {str(e)}")
+
+    def _start_flusher(self):
+        if self._flusher and self._flusher.is_alive():
+            return
+        with self._lock:
+            if self._flusher and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """把待写入的记录一次性写入本地数据库"""
+        with self._lock:
+            rows, self._pending = self._pending, []
+        if not rows:
+            return
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.executemany("INSERT INTO usage VALUES (?,?,?,?,?,?,?,?,?,?,?,?)", rows)
+            finally:
+                conn.close()
+        except Exception as e:
+            print(f"写入用量记录失败: {str(e)}")
+            with self._lock:
+                self._pending[:0] = rows
+
+
+usage_tracker = UsageTracker()